@@ -0,0 +1,80 @@
+# ProtectedField内存和脏标记传播性能测试，在仓库根目录运行：python3 -m benchmark.field_benchmark
+import sys
+import time
+import random
+import tracemalloc
+import layout.block_layout
+from common.protected_field import *
+from benchmark.layout_benchmark import *
+
+# 只有脏后代标记的布局对象，用来测字段本身
+class BenchObject:
+    def __init__(self, parent):
+        self.parent = parent
+        self.has_dirty_descendants = False
+        self.layout_root = False
+
+# 按排版的形状建字段：每个对象的x依赖前一个兄弟的x和width
+def build_fields(count):
+    root = BenchObject(None)
+    width = ProtectedField(root, "width", None, [])
+    fields = [width]
+    previous = None
+    for _ in range(count // 2):
+        obj = BenchObject(root)
+        deps = [previous.x, previous.width] if previous else [width]
+        obj.width = ProtectedField(obj, "width", root, [width])
+        obj.x = ProtectedField(obj, "x", root, deps)
+        fields.extend([obj.width, obj.x])
+        previous = obj
+    return fields
+
+def measure_memory(count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    fields = build_fields(count)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # 每个字段还带一个BenchObject的一半，单独减掉
+    tracemalloc.start()
+    before_objs = tracemalloc.get_traced_memory()[0]
+    objs = [BenchObject(None) for _ in range(count // 2)]
+    for obj in objs:
+        obj.width = obj.x = None
+    after_objs = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    per_field = ((after - before) - (after_objs - before_objs)) / len(fields)
+    print("{:8d} fields  {:7.1f} bytes/field".format(len(fields), per_field))
+
+def layout_fields(document):
+    fields = []
+    for obj in tree_to_list(document, []):
+        for value in vars(obj).values():
+            if isinstance(value, ProtectedField):
+                fields.append(value)
+    return fields
+
+# 在排好版的树上，把所有字段和对象恢复干净后逐个通知依赖者
+def measure_propagation(doc, rounds):
+    layout.block_layout.TEXT_RUNS = False
+    _, _, document, _ = run(doc, TEXT_MEASURE_CACHE_ENTRIES)
+    objs = tree_to_list(document, [])
+    fields = layout_fields(document)
+    elapsed = 0
+    for _ in range(rounds):
+        for field in fields:
+            field.dirty = False
+        for obj in objs:
+            obj.has_dirty_descendants = False
+        start = time.perf_counter()
+        for field in fields:
+            field.notify()
+        elapsed += time.perf_counter() - start
+    notified = len(fields) * rounds
+    print("{:8d} fields  {:7.0f}k notify/s".format(
+        len(fields), notified / elapsed / 1000))
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    measure_memory(count)
+    measure_propagation(generate_text_document(random.Random(0), 300), 5)
@@ -0,0 +1,164 @@
+# 排版文字测量性能测试，在仓库根目录运行：python3 -m benchmark.layout_benchmark
+import sys
+import time
+import random
+import layout.block_layout
+from layout.document_layout import *
+from layout.text_layout import *
+from parser.html_parser import *
+from parser.css_parser import *
+from utils.render_util import *
+from benchmark.parser_benchmark import WORDS
+
+TAGS = ["p", "div", "li", "h2"]
+INLINE_TAGS = ["b", "i", "span"]
+
+# 只有文字的文档，图片和iframe要加载资源，不在这里测
+def generate_text_document(rng, paragraphs):
+    out = ["<html><body>"]
+    for _ in range(paragraphs):
+        tag = rng.choice(TAGS)
+        parts = []
+        for _ in range(rng.randint(10, 80)):
+            word = rng.choice(WORDS)
+            if rng.random() < 0.1:
+                inline = rng.choice(INLINE_TAGS)
+                word = "<{}>{}</{}>".format(inline, word, inline)
+            parts.append(word)
+        out.append("<{}>{}</{}>".format(tag, " ".join(parts), tag))
+    out.append("</body></html>")
+    return "".join(out)
+
+# 排版只需要样式缓存和重绘请求，不用启动整个浏览器
+class BenchFrame:
+    def __init__(self):
+        self.style_cache = StyleSharingCache()
+        self.restyled_nodes = 0
+        self.layout_roots = []
+
+    def set_needs_render(self):
+        pass
+
+    def invalidate_paint(self, node):
+        pass
+
+    def defer_layout(self, block):
+        return False
+
+# 和Frame一样按视口推迟排版：离视口太远的块先只估算高度
+class ViewportFrame(BenchFrame):
+    def __init__(self, frame_height):
+        super().__init__()
+        self.frame_height = frame_height
+        self.deferred_blocks = []
+
+    def defer_layout(self, block):
+        if block.y.get() <= self.frame_height + LAZY_LAYOUT_MARGIN:
+            return False
+        self.deferred_blocks.append(block)
+        return True
+
+def paint_text(document):
+    cmds = []
+    for obj in tree_to_list(document, []):
+        if isinstance(obj, TextLayout):
+            cmds.extend(obj.paint())
+    return cmds
+
+# 首次排版、改窗口宽度重新换行、改缩放，每次都把文字绘制一遍
+def run(doc, max_entries):
+    TEXT_MEASURE_CACHE.clear()
+    TEXT_MEASURE_CACHE.max_entries = max_entries
+    frame = BenchFrame()
+    root = HTMLParser(doc).parse()
+    style(root, RuleSet(list(DEFAULT_STYLE_SHEET)), frame)
+    document = DocumentLayout(root, frame)
+    start = time.perf_counter()
+    for width, zoom in [(1600, 1), (1000, 1), (1000, 2)]:
+        document.layout(width, zoom)
+        draws = len(paint_text(document))
+    elapsed = time.perf_counter() - start
+    return elapsed, TEXT_MEASURE_CACHE.stats(), document, draws
+
+def count_fields(objs):
+    return sum([
+        len([value for value in vars(obj).values()
+            if isinstance(value, ProtectedField)])
+        for obj in objs
+    ])
+
+# 按单词和按文本段排版，比较布局对象、字段和绘制命令的数量
+def compare_runs(doc):
+    for name, text_runs in [("words", False), ("runs", True)]:
+        layout.block_layout.TEXT_RUNS = text_runs
+        elapsed, stats, document, draws = \
+            run(doc, TEXT_MEASURE_CACHE_ENTRIES)
+        objs = tree_to_list(document, [])
+        print("{:<10} {:8d} objects {:8d} fields {:8d} DrawText  {:.3f}s".format(
+            name, len(objs), count_fields(objs), draws, elapsed))
+
+# 在一段很长的文字末尾逐个输入字符，比较重新分行和整段重排的单次耗时
+def typing_latency(words, incremental, keys=50):
+    TEXT_MEASURE_CACHE.max_entries = TEXT_MEASURE_CACHE_ENTRIES
+    rng = random.Random(0)
+    text = " ".join([rng.choice(WORDS) for _ in range(words)])
+    doc = "<html><body><div>{}</div><p>after</p></body></html>".format(text)
+    frame = BenchFrame()
+    root = HTMLParser(doc).parse()
+    rules = RuleSet(list(DEFAULT_STYLE_SHEET))
+    style(root, rules, frame)
+    document = DocumentLayout(root, frame)
+    document.layout(1000, 1)
+    node = root.children[0].children[0].children[0]
+    start = time.perf_counter()
+    for i in range(keys):
+        old_text = node.text
+        node.text += " " if i % 6 == 5 else "x"
+        if incremental:
+            mark_text_changed(node, old_text)
+        else:
+            mark_layout_children(node)
+        document.layout(1000, 1)
+    return (time.perf_counter() - start) / keys
+
+def first_layout(doc, frame):
+    TEXT_MEASURE_CACHE.clear()
+    root = HTMLParser(doc).parse()
+    style(root, RuleSet(list(DEFAULT_STYLE_SHEET)), frame)
+    document = DocumentLayout(root, frame)
+    start = time.perf_counter()
+    document.layout(1000, 1)
+    return time.perf_counter() - start, document
+
+# 首次排版时推迟视口外的块，和排版整页比较耗时
+def lazy_layout(doc):
+    full, document = first_layout(doc, BenchFrame())
+    blocks = len([
+        obj for obj in tree_to_list(document, [])
+        if isinstance(obj, BlockLayout)
+    ])
+    frame = ViewportFrame(HEIGHT)
+    lazy, _ = first_layout(doc, frame)
+    return full, lazy, len(frame.deferred_blocks), blocks
+
+if __name__ == "__main__":
+    paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    doc = generate_text_document(random.Random(0), paragraphs)
+    uncached, stats, _, _ = run(doc, 0)
+    calls = stats["hits"] + stats["misses"]
+    print("{:<10} {:8d} measureText calls  {:.3f}s".format(
+        "uncached", calls, uncached))
+    cached, stats, _, _ = run(doc, TEXT_MEASURE_CACHE_ENTRIES)
+    print("{:<10} {:8d} measureText calls  {:.3f}s".format(
+        "cached", stats["misses"], cached))
+    print("saved {} of {} calls ({:.1f}%)".format(
+        stats["hits"], calls, 100 * stats["hits"] / calls))
+    compare_runs(doc)
+    full, lazy, deferred, blocks = lazy_layout(doc)
+    print("deferred {} of {} blocks  first layout {:.3f}s  full layout {:.3f}s".format(
+        deferred, blocks, lazy, full))
+    for words in [100, 1000, 10000]:
+        full = typing_latency(words, False)
+        reflow = typing_latency(words, True)
+        print("{:6d} words  relayout {:7.2f}ms/key  reflow {:6.2f}ms/key".format(
+            words, full * 1000, reflow * 1000))
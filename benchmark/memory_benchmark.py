@@ -0,0 +1,35 @@
+# DOM内存占用测试，在仓库根目录运行：python3 -m benchmark.memory_benchmark
+import sys
+import time
+import random
+import tracemalloc
+from parser.html_parser import *
+from utils.util import tree_to_list
+from benchmark.parser_benchmark import generate_document, count_nodes
+
+# 先用小文档估计每个节点平均占多少字节，再按目标节点数生成
+def generate_nodes(seed, target):
+    sample = generate_document(random.Random(seed), 100000)
+    per_node = len(sample) / count_nodes(HTMLParser(sample).parse())
+    return generate_document(random.Random(seed), int(target * per_node))
+
+def measure(name, doc, compact):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    root = HTMLParser(doc, compact=compact).parse()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    nodes = count_nodes(root)
+
+    start = time.perf_counter()
+    for _ in range(10):
+        tree_to_list(root, [])
+    elapsed = (time.perf_counter() - start) / 10
+    print("{:<10} {:8d} nodes  {:7.1f} bytes/node  tree_to_list {:.1f}ms".format(
+        name, nodes, (after - before) / nodes, elapsed * 1000))
+
+if __name__ == "__main__":
+    target = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    doc = generate_nodes(0, target)
+    measure("lists", doc, False)
+    measure("compact", doc, True)
@@ -0,0 +1,63 @@
+# HTML解析性能测试，在仓库根目录运行：python3 -m benchmark.parser_benchmark
+import sys
+import time
+import random
+from parser.html_parser import *
+
+TAGS = ["div", "p", "span", "b", "i", "a", "li", "h2", "section"]
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur",
+         "adipiscing", "elit", "sed", "do", "eiusmod", "tempor"]
+
+def generate_document(rng, size):
+    out = ["<!doctype html><html><head><title>Bench</title>",
+           "<link rel=stylesheet href=/style.css></head><body>"]
+    length = sum([len(part) for part in out])
+    i = 0
+    while length < size:
+        tag = rng.choice(TAGS)
+        words = " ".join([rng.choice(WORDS) for _ in range(rng.randint(1, 30))])
+        part = "<{} class=c{} id=\"n{}\" data-x='{} {}'>{}</{}>".format(
+            tag, i % 7, i, i, tag, words, tag)
+        if i % 11 == 0:
+            part += "<br><img src=/img{}.png alt=\"picture {}\">".format(i, i)
+        if i % 17 == 0:
+            part = "<ul>" + "".join(["<li>" + word + "</li>" for word in WORDS]) + "</ul>"
+        out.append(part)
+        length += len(part)
+        i += 1
+    out.append("</body></html>")
+    return "".join(out)
+
+def count_nodes(node):
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children)
+    return count
+
+def bench(name, docs, parse):
+    total_bytes = sum([len(doc.encode("utf8")) for doc in docs])
+    start = time.perf_counter()
+    nodes = 0
+    for doc in docs:
+        nodes += count_nodes(parse(doc))
+    elapsed = time.perf_counter() - start
+    print("{:<16} {:8.2f} MB/s  {:8d} nodes  {:.3f}s".format(
+        name, total_bytes / elapsed / 1e6, nodes, elapsed))
+
+def parse_chunked(doc, chunk_size=16 * 1024):
+    parser = HTMLParser()
+    for i in range(0, len(doc), chunk_size):
+        parser.feed(doc[i:i + chunk_size])
+    return parser.close()
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = random.Random(0)
+    docs = [generate_document(rng, size) for _ in range(4)]
+    print("corpus: {} documents, {:.1f} MB".format(
+        len(docs), sum([len(doc) for doc in docs]) / 1e6))
+    bench("parse()", docs, lambda doc: HTMLParser(doc).parse())
+    bench("feed(16KB)", docs, parse_chunked)
@@ -0,0 +1,91 @@
+# 后代选择器匹配性能测试，在仓库根目录运行：python3 -m benchmark.selector_benchmark
+import sys
+import time
+import random
+from parser.css_parser import *
+from parser.dom_index import *
+
+TAGS = ["div", "section", "article", "span", "p", "ul", "li", "em", "b", "i"]
+RARE_TAGS = ["nav", "aside", "header", "footer", "main", "figure"]
+QUERY_SELECTORS = ["section span", "ul li em", "article p b", "body i"]
+
+# 生成一棵又深又窄的树：若干条很深的链，链上偶尔分叉出叶子
+def generate_tree(rng, chains, depth):
+    root = Element("html", {}, None)
+    body = Element("body", {}, root)
+    root.children.append(body)
+    for _ in range(chains):
+        parent = body
+        for level in range(depth):
+            node = Element(rng.choice(TAGS), {}, parent)
+            parent.children.append(node)
+            if rng.random() < 0.3:
+                leaf = Element(rng.choice(TAGS), {}, parent)
+                parent.children.append(leaf)
+                leaf.children.append(Text("x", leaf))
+            parent = node
+    return root
+
+# 大部分规则的祖先是文档里没有的标签，这正是过滤器要快速排除的情况
+def generate_rules(rng, count):
+    rules = []
+    for i in range(count):
+        ancestor = rng.choice(RARE_TAGS if i % 4 else TAGS)
+        descendant = rng.choice(TAGS)
+        rules.append("{} {} {{ color: red }}".format(ancestor, descendant))
+    return CSSParser("\n".join(rules)).parse()
+
+def match_all(root, rule_set, use_filter):
+    matched = 0
+    ancestors = AncestorFilter()
+    stack = [(root, False)]
+    while stack:
+        node, leaving = stack.pop()
+        if leaving:
+            ancestors.pop(node)
+            continue
+        for media, selector, body in rule_set.candidates(node):
+            if selector.matches(node, ancestors if use_filter else None):
+                matched += 1
+        if node.children:
+            ancestors.push(node)
+            stack.append((node, True))
+            stack.extend([(child, False) for child in node.children[::-1]])
+    return matched
+
+def bench(name, root, rule_set, use_filter):
+    start = time.perf_counter()
+    matched = match_all(root, rule_set, use_filter)
+    elapsed = time.perf_counter() - start
+    print("{:<10} {:8d} matches  {:.3f}s".format(name, matched, elapsed))
+    return matched
+
+if __name__ == "__main__":
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    rng = random.Random(0)
+    root = generate_tree(rng, 20, depth)
+    rule_set = RuleSet(generate_rules(rng, 400))
+    index = DOMIndex()
+    index.root = root
+    index.rebuild()
+    print("{} elements, depth {}, {} descendant rules".format(
+        index.element_count(), depth, len(rule_set.rules)))
+    without = bench("walk", root, rule_set, False)
+    with_filter = bench("bloom", root, rule_set, True)
+    assert without == with_filter
+
+    # 查询用的选择器在生成的树里都有匹配，索引查询和遍历整棵树的结果必须相同
+    for text in QUERY_SELECTORS:
+        selector = CSSParser(text).selector()
+        start = time.perf_counter()
+        naive = [
+            node for node in tree_to_list(root, [])
+            if isinstance(node, Element) and selector.matches(node)
+        ]
+        naive_time = time.perf_counter() - start
+        start = time.perf_counter()
+        indexed = index.query(selector)
+        indexed_time = time.perf_counter() - start
+        assert naive and naive == indexed
+        print("{:<12} {:8d} nodes  naive {:.3f}s  index {:.3f}s".format(
+            text, len(naive), naive_time, indexed_time))
@@ -0,0 +1,367 @@
+import os
+import json
+import time
+import types
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from parser.css_parser import CSSParser
+
+# 磁盘缓存放在当前用户自己的缓存目录里，别的用户不能读写
+HTTP_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or
+    os.path.join(os.path.expanduser("~"), ".cache"),
+    "browser", "http")
+MEMORY_CACHE_ENTRIES = 64
+MEMORY_CACHE_BYTES = 16 * 1024 * 1024
+DISK_CACHE_BYTES = 128 * 1024 * 1024
+STYLE_SHEET_CACHE_ENTRIES = 64
+STYLE_SHEET_CACHE_BYTES = 8 * 1024 * 1024
+
+def parse_cache_control(value):
+    directives = {}
+    for item in value.split(","):
+        item = item.strip().casefold()
+        if not item: continue
+        if "=" in item:
+            key, val = item.split("=", 1)
+            directives[key.strip()] = val.strip().strip('"')
+        else:
+            directives[item] = True
+    return directives
+
+# 描述传输方式的首部，缓存里存的是解压、去掉分块以后的内容，这些首部要按内容重写
+TRANSFER_HEADERS = ["content-encoding", "content-length", "transfer-encoding"]
+
+class CacheEntry:
+    def __init__(self, url, headers, content):
+        self.url = url
+        self.headers = dict(headers)
+        self.set_content(content)
+        self.stored_at = time.time()
+
+    def set_content(self, content):
+        self.content = content
+        for header in TRANSFER_HEADERS:
+            self.headers.pop(header, None)
+        self.headers["content-length"] = str(len(content))
+
+    def max_age(self):
+        directives = parse_cache_control(self.headers.get("cache-control", ""))
+        if "no-cache" in directives: return 0
+        try:
+            return int(directives.get("max-age", 0))
+        except ValueError:
+            return 0
+
+    def is_fresh(self):
+        return time.time() - self.stored_at < self.max_age()
+
+    def validators(self):
+        headers = {}
+        if "etag" in self.headers:
+            headers["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            headers["If-Modified-Since"] = self.headers["last-modified"]
+        return headers
+
+    # 304响应的首部覆盖旧首部，并重新开始计算新鲜度
+    def revalidate(self, headers):
+        for header, value in headers.items():
+            if header in TRANSFER_HEADERS: continue
+            self.headers[header] = value
+        self.stored_at = time.time()
+
+    def size(self):
+        return len(self.content)
+
+# 带Vary的响应要按请求首部区分，这个缓存只按URL索引，所以不存
+def is_storable(headers):
+    if "vary" in headers: return False
+    directives = parse_cache_control(headers.get("cache-control", ""))
+    if "no-store" in directives: return False
+    if "max-age" in directives: return True
+    return "etag" in headers or "last-modified" in headers
+
+# HTTP缓存：内存中的LRU + 有大小上限的磁盘缓存
+class HTTPCache:
+    def __init__(self, directory=HTTP_CACHE_DIR,
+                 memory_entries=MEMORY_CACHE_ENTRIES,
+                 memory_bytes=MEMORY_CACHE_BYTES,
+                 disk_bytes=DISK_CACHE_BYTES):
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_entries = memory_entries
+        self.memory_bytes = memory_bytes
+        self.memory_size = 0
+
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.disk_size = 0
+        self.disk_enabled = True
+        self.disk_ready = False
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.bytes_saved = 0
+
+    # 第一次用到磁盘时才检查缓存目录，第一次写入时才创建它，只导入模块不会碰文件系统。
+    # 目录必须属于当前用户，并且只有当前用户能访问。调用者持有锁
+    def open_disk(self, create):
+        if self.disk_ready: return True
+        if not self.disk_enabled: return False
+        try:
+            if create:
+                os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            elif not os.path.isdir(self.directory):
+                return False
+            if os.stat(self.directory).st_uid != os.getuid():
+                raise OSError("cache directory owned by another user")
+            os.chmod(self.directory, 0o700)
+            for name in os.listdir(self.directory):
+                self.disk_size += \
+                    os.path.getsize(os.path.join(self.directory, name))
+        except OSError:
+            self.disk_enabled = False
+            return False
+        self.disk_ready = True
+        return True
+
+    def path_for(self, url):
+        name = hashlib.sha1(url.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def get(self, url):
+        self.lock.acquire(blocking=True)
+        entry = self.memory.get(url)
+        if entry:
+            self.memory.move_to_end(url)
+        self.lock.release()
+        if entry: return entry
+
+        entry = self.read_disk(url)
+        if entry:
+            self.lock.acquire(blocking=True)
+            self.put_memory(entry)
+            self.lock.release()
+        return entry
+
+    def put(self, entry):
+        # 304响应可能带来新的首部，让条目变得不能再存
+        if not is_storable(entry.headers):
+            self.remove(entry.url)
+            return
+        self.lock.acquire(blocking=True)
+        old = self.memory.pop(entry.url, None)
+        if old: self.memory_size -= old.size()
+        self.put_memory(entry)
+        self.lock.release()
+        self.write_disk(entry)
+
+    def remove(self, url):
+        self.lock.acquire(blocking=True)
+        old = self.memory.pop(url, None)
+        if old: self.memory_size -= old.size()
+        if self.open_disk(False):
+            self.remove_disk(self.path_for(url))
+        self.lock.release()
+
+    def put_memory(self, entry):
+        if entry.size() > self.memory_bytes: return
+        self.memory[entry.url] = entry
+        self.memory_size += entry.size()
+        while len(self.memory) > self.memory_entries or \
+            self.memory_size > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= evicted.size()
+
+    # 每个条目存成两个文件：JSON格式的首部和原样的响应体。
+    # 读出来的只是字符串和字节，文件内容不会被当作代码执行
+    def read_disk(self, url):
+        self.lock.acquire(blocking=True)
+        ready = self.open_disk(False)
+        self.lock.release()
+        if not ready: return None
+        path = self.path_for(url)
+        try:
+            with open(path + ".json", "r", encoding="utf8") as f:
+                header = json.load(f)
+            with open(path + ".body", "rb") as f:
+                content = f.read()
+            os.utime(path + ".json")
+            if header["url"] != url or header["size"] != len(content):
+                return None
+            headers = dict([
+                (str(key), str(value))
+                for key, value in header["headers"].items()
+            ])
+            stored_at = float(header["stored_at"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+        entry = CacheEntry(url, headers, content)
+        entry.stored_at = stored_at
+        return entry
+
+    def write_disk(self, entry):
+        if not self.disk_enabled: return
+        if entry.size() > self.disk_bytes: return
+        path = self.path_for(entry.url)
+        header = json.dumps({
+            "url": entry.url,
+            "headers": entry.headers,
+            "stored_at": entry.stored_at,
+            "size": entry.size(),
+        }).encode("utf8")
+        self.lock.acquire(blocking=True)
+        if not self.open_disk(True):
+            self.lock.release()
+            return
+        try:
+            self.remove_disk(path)
+            # 先写响应体再写首部，读的时候首部里的长度对不上就丢弃
+            self.write_file(path + ".body", entry.content)
+            self.write_file(path + ".json", header)
+            self.disk_size += len(entry.content) + len(header)
+            self.evict_disk()
+        except OSError:
+            pass
+        self.lock.release()
+
+    # 先写到临时文件(权限0600)再改名，读的一方不会看到写了一半的文件
+    def write_file(self, path, data):
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp, path)
+        except OSError:
+            os.remove(temp)
+            raise
+
+    def remove_disk(self, path):
+        for name in [path + ".json", path + ".body"]:
+            try:
+                size = os.path.getsize(name)
+                os.remove(name)
+                self.disk_size -= size
+            except OSError:
+                pass
+
+    # 按最近访问时间淘汰，直到磁盘占用低于上限
+    def evict_disk(self):
+        if self.disk_size <= self.disk_bytes: return
+        entries = {}
+        for name in os.listdir(self.directory):
+            stat = os.stat(os.path.join(self.directory, name))
+            stem = os.path.splitext(name)[0]
+            mtime = entries.get(stem, 0)
+            entries[stem] = max(mtime, stat.st_mtime)
+        for stem in sorted(entries, key=entries.get):
+            if self.disk_size <= self.disk_bytes: break
+            self.remove_disk(os.path.join(self.directory, stem))
+
+    def record_hit(self, entry):
+        self.lock.acquire(blocking=True)
+        self.hits += 1
+        self.bytes_saved += entry.size()
+        self.lock.release()
+
+    def record_revalidation(self, entry):
+        self.lock.acquire(blocking=True)
+        self.revalidations += 1
+        self.bytes_saved += entry.size()
+        self.lock.release()
+
+    def record_miss(self):
+        self.lock.acquire(blocking=True)
+        self.misses += 1
+        self.lock.release()
+
+    def stats(self):
+        self.lock.acquire(blocking=True)
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "bytes_saved": self.bytes_saved,
+        }
+        self.lock.release()
+        return stats
+
+HTTP_CACHE = HTTPCache()
+
+# 解析好的样式表缓存，按内容哈希索引，也可以按URL和校验器直接找到
+# 缓存的规则列表是元组，每条规则的声明包成只读的MappingProxyType，
+# 多个Frame共享同一份规则对象，谁也改不了别人的规则
+class StyleSheetCache:
+    def __init__(self, max_entries=STYLE_SHEET_CACHE_ENTRIES,
+                 max_bytes=STYLE_SHEET_CACHE_BYTES):
+        self.lock = threading.Lock()
+        self.sheets = OrderedDict()
+        self.sizes = {}
+        self.validated = {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url, headers, content):
+        validator = headers.get("etag") or headers.get("last-modified")
+        key = (url, validator) if validator else None
+
+        self.lock.acquire(blocking=True)
+        digest = self.validated.get(key) if key else None
+        if not digest or digest not in self.sheets:
+            digest = hashlib.sha1(content).hexdigest()
+        rules = self.sheets.get(digest)
+        if rules is not None:
+            self.sheets.move_to_end(digest)
+            self.hits += 1
+            if key: self.validated[key] = digest
+            self.lock.release()
+            return rules
+        self.misses += 1
+        self.lock.release()
+
+        rules = tuple([
+            (media, selector, types.MappingProxyType(body))
+            for media, selector, body
+            in CSSParser(content.decode("utf8", "replace")).parse()
+        ])
+
+        self.lock.acquire(blocking=True)
+        if digest not in self.sheets and len(content) <= self.max_bytes:
+            self.sheets[digest] = rules
+            self.sizes[digest] = len(content)
+            self.size += len(content)
+            self.evict()
+        if key: self.validated[key] = digest
+        self.lock.release()
+        return rules
+
+    def evict(self):
+        while len(self.sheets) > self.max_entries or \
+            self.size > self.max_bytes:
+            digest, _ = self.sheets.popitem(last=False)
+            self.size -= self.sizes.pop(digest)
+        if len(self.validated) > 2 * self.max_entries:
+            self.validated = dict([
+                (key, digest) for key, digest in self.validated.items()
+                if digest in self.sheets
+            ])
+
+    def stats(self):
+        self.lock.acquire(blocking=True)
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.sheets),
+        }
+        self.lock.release()
+        return stats
+
+STYLE_SHEET_CACHE = StyleSheetCache()
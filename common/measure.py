@@ -40,6 +40,19 @@ class MeasureTime:
         self.file.flush()
         self.lock.release()
 
+    def counter(self, name, values):
+        ts = time.time() * 1000000
+        args = ", ".join(['"{}": {}'.format(key, value)
+                          for key, value in values.items()])
+        self.lock.acquire(blocking=True)
+        self.file.write(
+            ', { "ph": "C", "cat": "_",' +
+            '"name": "' + name + '",' +
+            '"ts": ' + str(ts) + ',' +
+            '"pid": 1, "args": {' + args + '}}')
+        self.file.flush()
+        self.lock.release()
+
     def finish(self):
         self.lock.acquire(blocking=True)
         for thread in threading.enumerate():
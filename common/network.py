@@ -1,7 +1,119 @@
 import socket
 import ssl
+import threading
+import time
+import zlib
+import concurrent.futures
+from common.cache import *
 
 COOKIE_JAR = {}
+
+SSL_CONTEXT = None
+def get_ssl_context():
+    global SSL_CONTEXT
+    if not SSL_CONTEXT:
+        SSL_CONTEXT = ssl.create_default_context()
+    return SSL_CONTEXT
+
+class Connection:
+    def __init__(self, scheme, host, port):
+        s = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP,
+        )
+        s.connect((host, port))
+        if scheme == "https":
+            s = get_ssl_context().wrap_socket(s, server_hostname=host)
+        self.socket = s
+        self.file = s.makefile("b")
+        self.reused = False
+        self.last_used = time.time()
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    # 别的线程可能正阻塞在读上，shutdown能让读立刻返回，关闭留给读的线程
+    def abort(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+# 连接池，按(scheme, host, port)复用keep-alive连接
+class ConnectionPool:
+    def __init__(self, max_per_host=6, idle_timeout=30):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.condition = threading.Condition()
+        self.idle = {}
+        self.active = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, key, reuse=True):
+        self.condition.acquire(blocking=True)
+        while self.active.get(key, 0) >= self.max_per_host:
+            self.condition.wait()
+        self.active[key] = self.active.get(key, 0) + 1
+        expired = self.evict_idle()
+        conn = None
+        if reuse and self.idle.get(key):
+            conn = self.idle[key].pop()
+            conn.reused = True
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.condition.release()
+
+        for old in expired:
+            old.close()
+        if conn: return conn
+        try:
+            return Connection(*key)
+        except Exception:
+            self.release(key, None, False)
+            raise
+
+    def release(self, key, conn, keep_alive):
+        self.condition.acquire(blocking=True)
+        self.active[key] -= 1
+        if conn and keep_alive:
+            conn.last_used = time.time()
+            self.idle.setdefault(key, []).append(conn)
+            conn = None
+        self.condition.notify_all()
+        self.condition.release()
+        if conn: conn.close()
+
+    def evict_idle(self):
+        expired = []
+        now = time.time()
+        for key, conns in self.idle.items():
+            alive = [conn for conn in conns
+                     if now - conn.last_used < self.idle_timeout]
+            expired.extend([conn for conn in conns if conn not in alive])
+            self.idle[key] = alive
+        return expired
+
+    def stats(self):
+        self.condition.acquire(blocking=True)
+        idle = sum([len(conns) for conns in self.idle.values()])
+        stats = {"hits": self.hits, "misses": self.misses, "idle": idle}
+        self.condition.release()
+        return stats
+
+CONNECTION_POOL = ConnectionPool()
+
+# 子资源并行下载
+FETCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix="Fetch thread")
+
+def fetch(url, referrer):
+    return FETCH_EXECUTOR.submit(url.request, referrer)
+
 class URL:
     def __init__(self, url):
         self.scheme, url = url.split("://", 1)
@@ -18,25 +130,71 @@ class URL:
         if ":" in self.host:
             self.host, port = self.host.split(":", 1)
             self.port = int(port)
-    
+
     def request(self, referrer, payload=None):
-        s = socket.socket(
-            family=socket.AF_INET,
-            type=socket.SOCK_STREAM,
-            proto=socket.IPPROTO_TCP,
-        )
-        s.connect((self.host, self.port))
-    
-        if self.scheme == "https":
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=self.host)
+        response_headers, body = self.stream(referrer, payload)
+        return response_headers, read_all(body)
+
+    # 返回首部和一个可以边收边读的body，读完后连接自动归还连接池
+    def stream(self, referrer, payload=None):
+        url = str(self)
+        if payload:
+            HTTP_CACHE.remove(url)
+            status, response_headers, body = self.send(referrer, payload)
+            return response_headers, body
+        # HTTP缓存：新鲜的直接返回，过期的带上校验器重新验证
+        entry = HTTP_CACHE.get(url)
+        if entry and entry.is_fresh():
+            HTTP_CACHE.record_hit(entry)
+            return entry.headers, BufferBody(entry.content)
+        validators = entry.validators() if entry else {}
+        status, response_headers, body = \
+            self.send(referrer, None, validators)
+        if status == "304" and entry:
+            read_all(body)
+            entry.revalidate(response_headers)
+            HTTP_CACHE.put(entry)
+            HTTP_CACHE.record_revalidation(entry)
+            return entry.headers, BufferBody(entry.content)
+        HTTP_CACHE.record_miss()
+        if status == "200" and is_storable(response_headers):
+            body = CachingBody(body, CacheEntry(url, response_headers, b""))
+        return response_headers, body
+
+    def send(self, referrer, payload, extra_headers=None):
+        if extra_headers is None: extra_headers = {}
+        key = (self.scheme, self.host, self.port)
+        # 复用的连接可能已被服务器关闭，此时换一条新连接重试一次。
+        # 带body的请求不是幂等的，重发可能让服务器处理两次，
+        # 所以它们总是用新连接，出错也不重试
+        for attempt in range(2):
+            reuse = attempt == 0 and payload is None
+            conn = CONNECTION_POOL.acquire(key, reuse=reuse)
+            try:
+                status, response_headers, body, keep_alive = \
+                    self.exchange(conn, referrer, payload, extra_headers)
+            except OSError:
+                CONNECTION_POOL.release(key, conn, False)
+                if conn.reused: continue
+                raise
+            except Exception:
+                CONNECTION_POOL.release(key, conn, False)
+                raise
+            return status, response_headers, \
+                PooledBody(body, key, conn, keep_alive)
+
+    def exchange(self, conn, referrer, payload, extra_headers):
         # Header
         method = "POST" if payload else "GET"
-        request = "{} {} HTTP/1.0\r\n".format(method, self.path)
+        request = "{} {} HTTP/1.1\r\n".format(method, self.path)
         if payload:
             length = len(payload.encode("utf8"))
             request += "Content-Length: {}\r\n".format(length)
         request += "Host: {}\r\n".format(self.host)
+        request += "Connection: keep-alive\r\n"
+        request += "Accept-Encoding: gzip, deflate\r\n"
+        for header, value in extra_headers.items():
+            request += "{}: {}\r\n".format(header, value)
         if self.host in COOKIE_JAR:
             cookie, params = COOKIE_JAR[self.host]
             allow_cookie = True
@@ -48,11 +206,13 @@ class URL:
         request += "\r\n"
         # Body
         if payload: request += payload
-        s.send(request.encode("utf8"))
+        conn.socket.sendall(request.encode("utf8"))
 
-        response = s.makefile("b")
+        response = conn.file
         # Response Status
         statusline = response.readline().decode("utf8")
+        if not statusline:
+            raise ConnectionResetError("Connection closed by server")
         version, status, explanation = statusline.split(" ", 2)
         # Response Header
         response_headers = {}
@@ -73,14 +233,19 @@ class URL:
                         value = "true"
                     params[param.strip().casefold()] = value.casefold()
             COOKIE_JAR[self.host] = (cookie, params)
-        assert "transfer-encoding" not in response_headers
-        assert "content-encoding" not in response_headers
+
+        connection = response_headers.get("connection", "").casefold()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
         # Response Content
-        content = response.read()
-        s.close()
+        body = response_body(response, status, response_headers)
+        if isinstance(body, CloseDelimitedBody):
+            keep_alive = False
+
+        return status, response_headers, body, keep_alive
 
-        return response_headers, content
-    
     def resolve(self, url):
         if "://" in url: return URL(url)
         if not url.startswith("/"):
@@ -95,7 +260,7 @@ class URL:
         else:
             return URL(self.scheme + "://" + self.host + \
                        ":" + str(self.port) + url)
-        
+
     def __str__(self):
         port_part = ":" + str(self.port)
         if self.scheme == "https" and self.port == 443:
@@ -103,6 +268,188 @@ class URL:
         if self.scheme == "http" and self.port == 80:
             port_part = ""
         return self.scheme + "://" + self.host + port_part + self.path
-    
+
     def origin(self):
-        return self.scheme + "://" + self.host + ":" + str(self.port)
\ No newline at end of file
+        return self.scheme + "://" + self.host + ":" + str(self.port)
+
+# 响应体解码器：每次read只从socket读取并解码一小段，不缓冲整个响应
+READ_SIZE = 16 * 1024
+
+class LengthBody:
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=READ_SIZE):
+        if self.remaining <= 0: return b""
+        data = self.file.read1(min(size, self.remaining))
+        if not data:
+            raise ConnectionResetError("Connection closed in response body")
+        self.remaining -= len(data)
+        return data
+
+class CloseDelimitedBody:
+    def __init__(self, file):
+        self.file = file
+
+    def read(self, size=READ_SIZE):
+        return self.file.read1(size)
+
+class ChunkedBody:
+    def __init__(self, file):
+        self.file = file
+        self.chunk_left = 0
+        self.done = False
+
+    def read(self, size=READ_SIZE):
+        if self.done: return b""
+        if self.chunk_left == 0:
+            size_line = self.file.readline()
+            if not size_line:
+                raise ConnectionResetError("Connection closed in chunked body")
+            self.chunk_left = int(size_line.split(b";", 1)[0].strip(), 16)
+            if self.chunk_left == 0:
+                # trailer
+                while True:
+                    line = self.file.readline()
+                    if line in [b"\r\n", b""]: break
+                self.done = True
+                return b""
+        data = self.file.read1(min(size, self.chunk_left))
+        if not data:
+            raise ConnectionResetError("Connection closed in chunked body")
+        self.chunk_left -= len(data)
+        if self.chunk_left == 0:
+            self.file.readline()
+        return data
+
+class DecompressBody:
+    def __init__(self, body, encoding):
+        self.body = body
+        self.encoding = encoding
+        if encoding == "deflate":
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+        else:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.started = False
+        self.done = False
+
+    def read(self, size=READ_SIZE):
+        while not self.done:
+            data = self.decompressor.unconsumed_tail
+            if not data:
+                data = self.body.read(size)
+            if not data:
+                self.done = True
+                return self.decompressor.flush()
+            try:
+                out = self.decompressor.decompress(data, size)
+            except zlib.error:
+                # 有些服务器的deflate没有zlib头
+                if self.started or self.encoding != "deflate": raise
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                out = self.decompressor.decompress(data, size)
+            self.started = True
+            if out: return out
+        return b""
+
+class BufferBody:
+    def __init__(self, content):
+        self.content = content
+        self.pos = 0
+
+    def read(self, size=READ_SIZE):
+        data = self.content[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+class PooledBody:
+    def __init__(self, body, key, conn, keep_alive):
+        self.body = body
+        self.key = key
+        self.conn = conn
+        self.keep_alive = keep_alive
+        self.released = False
+        self.aborted = False
+
+    def read(self, size=READ_SIZE):
+        if self.released: return b""
+        try:
+            data = self.body.read(size)
+        except Exception:
+            self.release(False)
+            raise
+        if not data:
+            self.release(self.keep_alive and not self.aborted)
+        return data
+
+    # 没读完就放弃的连接不能复用
+    def close(self):
+        self.release(False)
+
+    # 从别的线程停止正在读的body
+    def abort(self):
+        if self.released: return
+        self.aborted = True
+        self.conn.abort()
+
+    def release(self, keep_alive):
+        if self.released: return
+        self.released = True
+        CONNECTION_POOL.release(self.key, self.conn, keep_alive)
+
+class CachingBody:
+    def __init__(self, body, entry):
+        self.body = body
+        self.entry = entry
+        self.chunks = []
+
+    def read(self, size=READ_SIZE):
+        data = self.body.read(size)
+        if data:
+            self.chunks.append(data)
+        elif self.chunks != None:
+            self.entry.set_content(b"".join(self.chunks))
+            HTTP_CACHE.put(self.entry)
+            self.chunks = None
+        return data
+
+    def close(self):
+        self.chunks = None
+        self.body.close()
+
+    def abort(self):
+        self.chunks = None
+        self.body.abort()
+
+def response_body(file, status, headers):
+    if status in ["204", "304"] or status.startswith("1"):
+        body = LengthBody(file, 0)
+    elif headers.get("transfer-encoding", "").casefold() == "chunked":
+        body = ChunkedBody(file)
+    elif "content-length" in headers:
+        body = LengthBody(file, int(headers["content-length"]))
+    else:
+        body = CloseDelimitedBody(file)
+
+    encoding = headers.get("content-encoding", "identity").casefold()
+    if encoding in ["gzip", "x-gzip", "deflate"]:
+        body = DecompressBody(body, "deflate" if encoding == "deflate" else "gzip")
+    else:
+        assert encoding == "identity", \
+            "Unsupported content-encoding " + encoding
+    return body
+
+def read_all(body):
+    chunks = []
+    while True:
+        data = body.read()
+        if not data: break
+        chunks.append(data)
+    return b"".join(chunks)
@@ -1,6 +1,30 @@
 from setting.constant import *
 
+# 把一批字段的祖先都标记为有脏后代，遇到已经标记过的祖先就停下
+def set_ancestors_dirty_bits(parents):
+    last = None
+    for parent in parents:
+        if parent is last: continue
+        last = parent
+        while parent and not parent.has_dirty_descendants:
+            parent.has_dirty_descendants = True
+            if parent.layout_root:
+                add_layout_root(parent)
+                break
+            parent = parent.parent
+
+# 布局包含的块是脏标记的边界，里面的改动标到它为止，由文档排版时单独排它
+def add_layout_root(obj):
+    obj.frame.layout_roots.append(obj)
+
+# 大页面上有几十万个字段，用__slots__省掉实例字典，
+# 没有被依赖的字段不分配容器，依赖少的字段只用一个小元组
 class ProtectedField:
+    __slots__ = [
+        "obj", "name", "parent", "value", "dirty", "invalidations",
+        "frozen_dependencies", "frozen_invalidations",
+    ]
+
     def __init__(self, obj, name, parent=None, dependencies=None, invalidations=None):
         self.obj = obj
         self.name = name
@@ -8,11 +32,11 @@ class ProtectedField:
 
         self.value = None
         self.dirty = True
-        self.invalidations = set()
+        self.invalidations = ()
         self.frozen_dependencies = (dependencies != None)
         if dependencies != None:
             for dependency in dependencies:
-                dependency.invalidations.add(self)
+                dependency.add_invalidation(self)
         else:
             assert \
                 self.name in [
@@ -23,20 +47,44 @@ class ProtectedField:
         if invalidations != None:
             assert self.name == "children"
             for invalidation in invalidations:
-                self.invalidations.add(invalidation)
+                self.add_invalidation(invalidation)
+
+    def add_invalidation(self, field):
+        invalidations = self.invalidations
+        if type(invalidations) is tuple:
+            if field in invalidations: return
+            if len(invalidations) < SMALL_INVALIDATIONS:
+                self.invalidations = invalidations + (field,)
+                return
+            self.invalidations = invalidations = set(invalidations)
+        invalidations.add(field)
+
+    def remove_invalidation(self, field):
+        invalidations = self.invalidations
+        if type(invalidations) is tuple:
+            if field in invalidations:
+                self.invalidations = tuple([
+                    invalidation for invalidation in invalidations
+                    if invalidation is not field
+                ])
+        else:
+            invalidations.discard(field)
 
     def set_dependencies(self, dependencies):
         assert self.name in ["height", "ascent", "descent"] or \
             self.name in CSS_PROPERTIES
         assert self.name == "height" or not self.frozen_dependencies
         for dependency in dependencies:
-            dependency.invalidations.add(self)
+            dependency.add_invalidation(self)
         self.frozen_dependencies = True
 
     def set_ancestor_dirty_bits(self):
         parent = self.parent
         while parent and not parent.has_dirty_descendants:
             parent.has_dirty_descendants = True
+            if parent.layout_root:
+                add_layout_root(parent)
+                break
             parent = parent.parent
 
     def mark(self):
@@ -44,10 +92,15 @@ class ProtectedField:
         self.dirty = True
         self.set_ancestor_dirty_bits()
 
+    # 先把直接依赖的字段都标脏，再一次性向上设置祖先标记
     def notify(self):
+        parents = []
         for field in self.invalidations:
-            field.mark()
-        self.set_ancestor_dirty_bits()
+            if field.dirty: continue
+            field.dirty = True
+            parents.append(field.parent)
+        parents.append(self.parent)
+        set_ancestors_dirty_bits(parents)
 
     def set(self, value):
         # if self.value != None:
@@ -65,7 +118,7 @@ class ProtectedField:
         if notify.frozen_dependencies or self.frozen_invalidations:
             assert notify in self.invalidations
         else:
-            self.invalidations.add(notify)
+            self.add_invalidation(notify)
 
         if False:
             prefix = ""
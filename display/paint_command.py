@@ -48,8 +48,9 @@ class DrawText(PaintCommand):
     def __init__(self, x1, y1, text, font, color):
         self.left = x1
         self.top = y1
-        self.right = x1 + font.measureText(text)
-        self.bottom = y1 - font.getMetrics().fAscent + font.getMetrics().fDescent
+        metrics = font_metrics(font)
+        self.right = x1 + measure_text(font, text)
+        self.bottom = y1 - metrics.fAscent + metrics.fDescent
         self.font = font
         self.text = text
         self.color = color
@@ -61,7 +62,7 @@ class DrawText(PaintCommand):
             AntiAlias=True,
             Color=parse_color(self.color),
         )
-        baseline = self.top - self.font.getMetrics().fAscent
+        baseline = self.top - font_metrics(self.font).fAscent
         canvas.drawString(self.text, float(self.left), baseline,
             self.font, paint)
 
@@ -1,3 +1,6 @@
+import re
+import math
+import bisect
 from common.protected_field import *
 from layout.iframe_layout import *
 from layout.image_layout import *
@@ -18,6 +21,9 @@ BLOCK_ELEMENTS = [
     "legend", "details", "summary"
 ]
 
+# 和str.split()一样，按空白切出的单词
+WORD = re.compile(r"\S+")
+
 class BlockLayout:
     def __init__(self, node, parent, previous, frame):
         self.node = node
@@ -39,7 +45,31 @@ class BlockLayout:
 
         self.children = ProtectedField(self, "children", self.parent, None, [])
 
+        # 行内排版的输入：按文档顺序排好的(节点, 单词)，元素的单词是None
+        self.inline_items = None
+        # 每个文本节点的第一个单词在inline_items里的下标，
+        # 以及编辑过的节点里每个单词在文字中的位置
+        self.text_index = None
+        self.text_starts = None
+        self.word_offsets = None
+        # 文字编辑后需要重新分行的单词范围，和改动范围里不能再复用的旧行
+        self.reflow_from = None
+        self.reflow_until = None
+        self.reflow_index = None
+        self.stale_lines = set()
+        self.settled = False
+        self.detached = False
+        # 离视口很远、还没有真正排版的块
+        self.deferred = False
+        # content-visibility: auto的块，以及它跳过排版前的高度
+        self.skippable = False
+        self.remembered_height = None
+        # 尺寸包含的块不随内容变高，绘制包含的块缓存上次的绘制命令
+        self.fixed_height = None
+        self.paint_cache = None
+
         self.has_dirty_descendants = True
+        self.layout_root = False
 
     def layout_needed(self):
         if self.zoom.dirty: return True
@@ -48,11 +78,91 @@ class BlockLayout:
         if self.x.dirty: return True
         if self.y.dirty: return True
         if self.children.dirty: return True
+        if self.reflow_from is not None: return True
         if self.has_dirty_descendants: return True
         return False
+
+    def estimate_height(self):
+        zoom = self.zoom.read(notify=self.height)
+        width = self.width.read(notify=self.height)
+        node_font = font(self.node.style, zoom, notify=self.height)
+        char_width = measure_text(node_font, ESTIMATE_SAMPLE_TEXT) / \
+            len(ESTIMATE_SAMPLE_TEXT)
+        chars_per_line = max(1, int(width / char_width))
+        lines = 0
+        images = 0
+        for node in tree_to_list(self.node, []):
+            if isinstance(node, Text):
+                if not node.text.isspace():
+                    lines += math.ceil(len(node.text) / chars_per_line)
+            elif node.tag == "img" and node.image:
+                images += dpx(int(node.attributes.get(
+                    "height", node.image.height())), zoom)
+        return lines * linespace(node_font) * 1.25 + images
+
+    # 推迟排版的块没有子布局，排过版的沿用上次的高度，没排过的用文字量估算
+    def layout_deferred(self):
+        if self.children.dirty:
+            self.children.set([])
+        if self.fixed_height is not None:
+            self.height.set(self.layout_fixed_height())
+        elif self.remembered_height is not None:
+            self.height.set(self.remembered_height)
+        else:
+            self.height.set(self.estimate_height())
+        self.has_dirty_descendants = False
+
+    # 已经排过版的块重新跳过时，丢掉子布局，子孙节点不再指向它们。
+    # 整个子树都离开布局树：嵌套的推迟块、绘制缓存和挂在存活字段上的依赖边都要清掉
+    def defer(self):
+        self.deferred = True
+        children = self.children.value
+        if not children: return
+        self.remembered_height = self.height.value
+        stack = list(children)
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, BlockLayout):
+                obj.detach()
+                obj.deferred = False
+                if obj.paint_cache is not None:
+                    obj.paint_cache = None
+                    self.frame.paint_cached_blocks.discard(obj)
+                stack.extend(obj.children.value or [])
+            elif isinstance(obj, LineLayout):
+                obj.detach()
+        for node in tree_to_list(self.node, [])[1:]:
+            node.layout_object = None
+        self.children.mark()
+
+    def realize(self):
+        self.deferred = False
+        self.children.mark()
     
+    # 文本节点的非继承属性是共享的默认值，不会变，不用登记依赖
+    def read_style(self, property):
+        field = self.node.style[property]
+        if isinstance(self.node, Text):
+            return field.get()
+        return field.read(notify=self.children)
+
+    # 尺寸包含的块按height定高，没有给就当作空块
+    def layout_fixed_height(self):
+        self.height.set_dependencies([self.zoom])
+        return dpx(self.fixed_height, self.zoom.read(notify=self.height))
+
+    # 定高的块高度不依赖子布局，里面的变化不会传到外面
+    def set_height_dependencies(self, children):
+        if self.fixed_height is not None: return
+        height_dependencies = [child.height for child in children]
+        height_dependencies.append(self.children)
+        self.height.set_dependencies(height_dependencies)
+
     def layout(self):
         if not self.layout_needed(): return
+        if self.paint_cache is not None:
+            self.paint_cache = None
+            self.frame.paint_cached_blocks.discard(self)
 
         self.zoom.copy(self.parent.zoom)
         self.width.copy(self.parent.width)
@@ -65,37 +175,66 @@ class BlockLayout:
         else:
             self.y.copy(self.parent.y)
 
+        contain = self.read_style("contain")
+        self.layout_root = contain.layout
+        if contain.size:
+            self.fixed_height = self.read_style("height").px or 0
+        else:
+            self.fixed_height = None
+
+        self.skippable = self.read_style("content-visibility") == "auto"
+        if not self.deferred and \
+            (self.skippable or self.children.value is None) and \
+            self.frame.defer_layout(self):
+            self.defer()
+        if self.deferred:
+            self.layout_deferred()
+            return
+
         mode = self.layout_mode()
         if mode == "block":
             if self.children.dirty:
+                # 还在文档里的子节点沿用原来的布局对象，只给新节点建布局
+                old_children = self.children.value or []
                 children = []
                 previous = None
                 for child in self.node.children:
-                    next = BlockLayout(child, self, previous, self.frame)
+                    next = child.layout_object
+                    if isinstance(next, BlockLayout) and \
+                        next.parent is self and not next.detached:
+                        next.set_previous(previous)
+                    else:
+                        next = BlockLayout(child, self, previous, self.frame)
                     children.append(next)
                     previous = next
+                kept = set(children)
+                for child in old_children:
+                    if isinstance(child, BlockLayout) and child not in kept:
+                        child.detach()
                 self.children.set(children)
-
-                height_dependencies = [child.height for child in children]
-                height_dependencies.append(self.children)
-                self.height.set_dependencies(height_dependencies)
+                self.set_height_dependencies(children)
         else:
             if self.children.dirty:
-                self.temp_children = []
-                self.new_line()
+                self.inline_items = []
+                self.text_index = {}
+                self.text_starts = []
+                self.word_offsets = {}
                 self.recurse(self.node)
-                self.children.set(self.temp_children)
-
-                height_dependencies = [child.height for child in self.temp_children]
-                height_dependencies.append(self.children)
-                self.height.set_dependencies(height_dependencies)
-                self.temp_children = None
+                self.temp_children = []
+                self.new_line(0)
+                self.flow(0)
+                self.finish_flow(self.temp_children)
+            elif self.reflow_from is not None:
+                self.reflow()
 
         for child in self.children.get():
             child.layout()
 
         self.has_dirty_descendants = False
 
+        if self.fixed_height is not None:
+            self.height.set(self.layout_fixed_height())
+            return
         children = self.children.read(notify=self.height)
         new_height = sum([
             child.height.read(notify=self.height)
@@ -103,6 +242,31 @@ class BlockLayout:
         ])
         self.height.set(new_height)
 
+    # 复用的布局对象前面换了兄弟，把y的依赖改到新的兄弟上
+    def set_previous(self, previous):
+        if previous is self.previous: return
+        self.y_dependency().remove_invalidation(self.y)
+        if self.previous:
+            self.previous.height.remove_invalidation(self.y)
+        self.previous = previous
+        self.y_dependency().add_invalidation(self.y)
+        if previous:
+            previous.height.add_invalidation(self.y)
+        self.y.mark()
+
+    def y_dependency(self):
+        return self.previous.y if self.previous else self.parent.y
+
+    # 节点离开文档后，摘掉挂在父布局字段上的依赖边
+    def detach(self):
+        self.parent.zoom.remove_invalidation(self.zoom)
+        self.parent.width.remove_invalidation(self.width)
+        self.parent.x.remove_invalidation(self.x)
+        self.y_dependency().remove_invalidation(self.y)
+        if self.previous:
+            self.previous.height.remove_invalidation(self.y)
+        self.detached = True
+
     def layout_mode(self):
         if isinstance(self.node, Text):
             return "inline"
@@ -117,17 +281,167 @@ class BlockLayout:
         else:
             return "block"
 
+    def flow(self, start):
+        for i in range(start, len(self.inline_items)):
+            self.item_index = i
+            node, word = self.inline_items[i]
+            if word is not None:
+                self.word(node, word)
+            elif node.tag == "br":
+                self.new_line(i + 1)
+            elif node.tag == "input" or node.tag == "button":
+                self.input(node)
+            elif node.tag == "img":
+                self.image(node)
+            else:
+                self.iframe(node)
+            if self.settled: break
+
+    # new_lines是这次新建的行，沿用的旧行已经是高度的依赖
+    def finish_flow(self, new_lines):
+        self.children.set(self.temp_children)
+        self.set_height_dependencies(new_lines)
+        self.temp_children = None
+        self.reflow_from = None
+        self.reflow_until = None
+        self.reflow_index = None
+        self.stale_lines = set()
+        self.settled = False
+
+    # 文本节点的内容变了：在inline_items里原地替换改动的单词，记下需要重新分行的范围。
+    # 只处理改动的单词和它后面的位置，行首在改动之后的行整体平移，
+    # 落在改动范围内的行不能再复用
+    def text_changed(self, node, old_text):
+        if self.children.dirty or self.inline_items is None or \
+            node not in self.text_index:
+            self.children.mark()
+            return
+        new_text = node.text
+        offsets = self.word_offsets.get(node)
+        if offsets is None:
+            offsets = self.word_offsets[node] = [
+                match.start() for match in WORD.finditer(old_text)]
+
+        # 改动的字符范围，向两边扩到单词边界
+        start = common_chars(old_text, new_text)
+        end = min(common_chars(old_text, new_text, True),
+            min(len(old_text), len(new_text)) - start)
+        old_end = len(old_text) - end
+        new_end = len(new_text) - end
+        while start > 0 and not old_text[start - 1].isspace():
+            start -= 1
+        while old_end < len(old_text) and not old_text[old_end].isspace():
+            old_end += 1
+            new_end += 1
+
+        first = bisect.bisect_left(offsets, start)
+        last = bisect.bisect_left(offsets, old_end)
+        matches = list(WORD.finditer(new_text, start, new_end))
+        shift = len(new_text) - len(old_text)
+        offsets[first:last] = [match.start() for match in matches]
+        if shift:
+            tail = first + len(matches)
+            offsets[tail:] = [offset + shift for offset in offsets[tail:]]
+
+        position = self.text_index[node]
+        changed_from = self.text_starts[position] + first
+        old_changed_until = self.text_starts[position] + last
+        new_changed_until = changed_from + len(matches)
+        delta = new_changed_until - old_changed_until
+        self.inline_items[changed_from:old_changed_until] = [
+            (node, match.group()) for match in matches]
+        if delta:
+            for i in range(position + 1, len(self.text_starts)):
+                self.text_starts[i] += delta
+
+        lines = self.children.get()
+        for i in range(max(first_line_at(lines, changed_from), 1), len(lines)):
+            line = lines[i]
+            if line.start >= old_changed_until:
+                line.start += delta
+            else:
+                line.start = changed_from
+                self.stale_lines.add(line)
+
+        if self.reflow_from is None:
+            self.reflow_from = changed_from
+            self.reflow_until = new_changed_until
+        else:
+            if self.reflow_until >= old_changed_until:
+                self.reflow_until += delta
+            self.reflow_from = min(self.reflow_from, changed_from)
+            self.reflow_until = max(self.reflow_until, new_changed_until)
+        self.children.set_ancestor_dirty_bits()
+
+    # 从改动所在的行开始重新分行，新行的行首和改动之后的某个旧行重合时，
+    # 后面的分行结果不会再变，直接把旧行接上
+    def reflow(self):
+        lines = self.children.get()
+        # 行首在改动位置之前的最后一行；改动的是行首的单词时，
+        # 它可能变短后挪到上一行，所以也从上一行开始
+        index = max(first_line_at(lines, self.reflow_from) - 1, 0)
+        start = lines[index].start
+
+        self.temp_children = lines[:index]
+        self.reflow_index = index
+        self.new_line(start, lines[index].wrapped)
+        self.flow(start)
+
+        if self.settled:
+            reused = len(self.temp_children) - len(lines) + self.settled_at
+            new_lines = self.temp_children[index:reused]
+            dropped = lines[index:self.settled_at]
+        else:
+            new_lines = self.temp_children[index:]
+            dropped = lines[index:]
+        for line in dropped:
+            line.detach()
+        self.finish_flow(new_lines)
+
+    # 改动之后行首和换行方式都相同、还能复用的旧行
+    def reusable_line(self, start, wrapped):
+        lines = self.children.get()
+        i = first_line_at(lines, start, self.reflow_index + 1)
+        while i < len(lines) and lines[i].start == start:
+            line = lines[i]
+            if line.wrapped == wrapped and line not in self.stale_lines:
+                return i
+            i += 1
+        return None
+
+    def settle(self, index):
+        lines = self.children.get()
+        line = lines[index]
+        previous = self.temp_children[-1]
+        line.previous = previous
+        previous.y.add_invalidation(line.y)
+        previous.height.add_invalidation(line.y)
+        line.y.mark()
+        self.settled_at = index
+        self.temp_children.extend(lines[index:])
+        self.settled = True
+
     def word(self, node, word):
         zoom = self.zoom.read(notify=self.children)
         node_font = font(node.style, zoom, notify=self.children)
-        w = node_font.measureText(word)
+        w = measure_text(node_font, word)
+        run = self.previous_word
+        if TEXT_RUNS and isinstance(run, TextLayout) and run.node is node \
+            and self.cursor_x + w <= self.width.read(notify=self.children):
+            run.add_word(word)
+            self.cursor_x += w + measure_text(node_font, ' ')
+            return
         self.add_inline_child(node, w, TextLayout, self.frame, word)
 
     def add_inline_child(self, node, w, child_class, frame, word=None):
         width = self.width.read(notify=self.children)
-        if self.cursor_x + w > width:
-            self.new_line()
         line = self.temp_children[-1]
+        # 因为放不下才换的行，第一个元素一定放在这一行
+        if self.cursor_x + w > width and \
+            not (line.wrapped and not line.children):
+            self.new_line(self.item_index, True)
+            if self.settled: return
+            line = self.temp_children[-1]
         if word:
             child = child_class(node, word, line, self.previous_word)
         else:
@@ -135,14 +449,22 @@ class BlockLayout:
         line.children.append(child)
         self.previous_word = child
         zoom = self.zoom.read(notify=self.children)
-        self.cursor_x += w + font(node.style, zoom, notify=self.children).measureText(' ')
+        self.cursor_x += w + \
+            measure_text(font(node.style, zoom, notify=self.children), ' ')
 
-    def new_line(self):
+    def new_line(self, start, wrapped=False):
+        if self.reflow_index is not None and start >= self.reflow_until:
+            index = self.reusable_line(start, wrapped)
+            if index is not None:
+                self.settle(index)
+                return
         self.previous_word = None
         self.cursor_x = 0
         last_line = self.temp_children[-1] \
             if self.temp_children else None
         new_line = LineLayout(self.node, self, last_line)
+        new_line.start = start
+        new_line.wrapped = wrapped
         self.temp_children.append(new_line)
         
     def image(self, node):
@@ -168,17 +490,19 @@ class BlockLayout:
      
     def recurse(self, node):
         if isinstance(node, Text):
+            self.text_index[node] = len(self.text_starts)
+            self.text_starts.append(len(self.inline_items))
             for word in node.text.split():
-                self.word(node, word)
+                self.inline_items.append((node, word))
         else:
-            if node.tag == "br":
-                self.new_line()
-            elif node.tag == "input" or node.tag == "button":
-                self.input(node)
+            if node.tag in ["br", "input", "button"]:
+                self.inline_items.append((node, None))
             elif node.tag == "img":
-                self.image(node)
+                # 图片还没下载完时先不参与排版
+                if node.image:
+                    self.inline_items.append((node, None))
             elif node.tag == "iframe" and "src" in node.attributes:
-                self.iframe(node)
+                self.inline_items.append((node, None))
             else:
                 for child in node.children:
                     self.recurse(child)
@@ -196,7 +520,7 @@ class BlockLayout:
         cmds = []
         bgcolor = self.node.style["background-color"].get()
         if bgcolor != "transparent":
-            radius = dpx(float(self.node.style["border-radius"].get()[:-2]), self.zoom.get())
+            radius = dpx(self.node.style["border-radius"].get().px, self.zoom.get())
             cmds.append(DrawRRect(self.self_rect(), radius, bgcolor))
         return cmds
     
@@ -214,7 +538,68 @@ class BlockLayout:
 
         cmds = paint_visual_effects(self.node, cmds, self.self_rect())
         return cmds
+
+    # 绘制包含的块画在自己的框里，里面的布局和样式没变就能复用绘制命令；
+    # iframe的内容由另一个frame绘制，含iframe的块不缓存
+    def cache_paint(self, cmds):
+        if not self.node.style["contain"].get().paint: return
+        for obj in tree_to_list(self, []):
+            if isinstance(obj, IframeLayout): return
+        self.paint_cache = cmds
+        self.frame.paint_cached_blocks.add(self)
     
     def __repr__(self):
         return "BlockLayout(x={}, y={}, width={}, height={}, node={})".format(
-            self.x, self.x, self.width, self.height, self.node)
\ No newline at end of file
+            self.x, self.x, self.width, self.height, self.node)
+
+# 两段文字开头(或结尾)相同的字符数。二分查找时只比较还没确定的那一段，
+# 总共只复制一遍文字，长段落里也很快
+def common_chars(a, b, from_end=False):
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if from_end:
+            same = b.endswith(a[len(a) - middle:len(a) - low], 0, len(b) - low)
+        else:
+            same = b.startswith(a[low:middle], low)
+        if same:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+# 行首不小于start的第一行(行按行首排好序)
+def first_line_at(lines, start, low=0):
+    high = len(lines)
+    while low < high:
+        middle = (low + high) // 2
+        if lines[middle].start < start:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+# 布局包含的块单独排版前，它和祖先都要还在布局树里
+def in_layout_tree(block):
+    obj = block
+    while isinstance(obj, BlockLayout):
+        if obj.detached: return False
+        obj = obj.parent
+    return True
+
+def enclosing_block(node):
+    while node and not isinstance(node.layout_object, BlockLayout):
+        node = node.parent
+    return node.layout_object if node else None
+
+# DOM子节点变化后，让最近的BlockLayout重新生成子布局
+def mark_layout_children(node):
+    block = enclosing_block(node)
+    if block:
+        block.children.mark()
+
+# 文本节点的内容变化后，只让排它的BlockLayout从改动的行开始重新分行
+def mark_text_changed(node, old_text):
+    block = enclosing_block(node)
+    if block:
+        block.text_changed(node, old_text)
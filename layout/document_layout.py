@@ -17,6 +17,7 @@ class DocumentLayout:
         self.y = ProtectedField(self, "y", None, [])
 
         self.has_dirty_descendants = True
+        self.layout_root = False
 
     def layout_needed(self):
         if self.zoom.dirty: return True
@@ -28,7 +29,7 @@ class DocumentLayout:
         return False
     
     def layout(self, width, zoom):
-        if not self.layout_needed(): return
+        if not self.layout_needed() and not self.frame.layout_roots: return
 
         self.zoom.set(zoom)
         self.width.set(width - 2 * dpx(HSTEP, zoom))
@@ -44,6 +45,16 @@ class DocumentLayout:
         self.y.set(dpx(VSTEP, zoom))
 
         child.layout()
+        # 包含块里的改动只标到包含块为止，祖先不用排版时单独排它们；
+        # 高度不固定的包含块排完变了高，会把外面标脏，再排一遍
+        while self.frame.layout_roots:
+            roots = self.frame.layout_roots
+            self.frame.layout_roots = []
+            for root in roots:
+                if not in_layout_tree(root): continue
+                self.frame.invalidate_paint(root.node)
+                root.layout()
+            child.layout()
         self.has_dirty_descendants = False
 
         self.height.copy(child.height)
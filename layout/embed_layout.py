@@ -37,6 +37,7 @@ class EmbedLayout:
             [self.ascent,self.parent.y, self.parent.ascent])
 
         self.has_dirty_descendants = True
+        self.layout_root = False
 
     def layout_needed(self):
         if self.zoom.dirty: return True
@@ -61,7 +62,7 @@ class EmbedLayout:
             prev_x = self.previous.x.read(notify=self.x)
             prev_font = self.previous.font.read(notify=self.x)
             prev_width = self.previous.width.read(notify=self.x)
-            self.x.set(prev_x + prev_font.measureText(' ') + prev_width)
+            self.x.set(prev_x + measure_text(prev_font, ' ') + prev_width)
         else:
             self.x.copy(self.parent.x)
 
@@ -44,8 +44,8 @@ class IframeLayout(EmbedLayout):
             self.y.get() + self.height.get())
         bgcolor = self.node.style["background-color"].get()
         if bgcolor != 'transparent':
-            radius = dpx(float(
-                self.node.style["border-radius"].get()[:-2]),
+            radius = dpx(
+                self.node.style["border-radius"].get().px,
                 self.zoom.get())
             cmds.append(DrawRRect(rect, radius, bgcolor))
         return cmds
@@ -32,7 +32,7 @@ class InputLayout(EmbedLayout):
         bgcolor = self.node.style["background-color"].get()
         if bgcolor != "transparent":
             radius = dpx(
-                float(self.node.style["border-radius"].get()[:-2]),
+                self.node.style["border-radius"].get().px,
                 self.zoom.get())
             cmds.append(DrawRRect(self.self_rect(), radius, bgcolor))
 
@@ -25,7 +25,24 @@ class LineLayout:
         self.height = ProtectedField(self, "height", self.parent,
             [self.ascent, self.descent])
 
+        self.start = 0
+        self.wrapped = False
         self.has_dirty_descendants = True
+        self.layout_root = False
+
+    # 重新分行时丢掉的行：摘掉挂在存活字段上的依赖边，不然这些行会一直留在内存里
+    def detach(self):
+        self.parent.zoom.remove_invalidation(self.zoom)
+        self.parent.x.remove_invalidation(self.x)
+        self.parent.width.remove_invalidation(self.width)
+        if self.previous:
+            self.previous.y.remove_invalidation(self.y)
+            self.previous.height.remove_invalidation(self.y)
+        else:
+            self.parent.y.remove_invalidation(self.y)
+        for child in self.children:
+            for property in ["font-weight", "font-style", "font-size"]:
+                child.node.style[property].remove_invalidation(child.font)
 
     def layout_needed(self):
         if self.zoom.dirty: return True
@@ -104,7 +121,7 @@ class LineLayout:
         outline_rect = skia.Rect.MakeEmpty()
         outline_node = None
         for child in self.children:
-            child_outline = parse_outline(child.node.parent.style["outline"].get())
+            child_outline = child.node.parent.style["outline"].get().outline
             if child_outline:
                 outline_rect.join(child.self_rect())
                 outline_node = child.node.parent
@@ -1,9 +1,11 @@
 from common.protected_field import *
 from utils.render_util import *
 
+# 同一行里同一个文本节点的连续单词合成一段，共用一组字段和一条绘制命令
 class TextLayout:
     def __init__(self, node, word, parent, previous):
         self.node = node
+        self.words = [word]
         self.word = word
         self.children = []
         self.parent = parent
@@ -35,6 +37,11 @@ class TextLayout:
             [self.ascent, self.parent.y, self.parent.ascent])
 
         self.has_dirty_descendants = True
+        self.layout_root = False
+
+    # 只在BlockLayout生成子布局时调用，这时还没有排版过
+    def add_word(self, word):
+        self.words.append(word)
 
     def layout_needed(self):
         if self.zoom.dirty: return True
@@ -56,14 +63,20 @@ class TextLayout:
         zoom = self.zoom.read(notify=self.font)
         self.font.set(font(self.node.style, zoom, notify=self.font))
 
+        # 逐词量宽度再加上空格，和每个词单独排版时的位置完全一致
         f = self.font.read(notify=self.width)
-        self.width.set(f.measureText(self.word))
+        space = measure_text(f, ' ')
+        self.word = " ".join(self.words)
+        x = 0
+        for word in self.words:
+            x += measure_text(f, word) + space
+        self.width.set(x - space)
 
         f = self.font.read(notify=self.ascent)
-        self.ascent.set(f.getMetrics().fAscent * 1.25)
+        self.ascent.set(font_metrics(f).fAscent * 1.25)
 
         f = self.font.read(notify=self.descent)
-        self.descent.set(f.getMetrics().fDescent * 1.25)
+        self.descent.set(font_metrics(f).fDescent * 1.25)
 
         f = self.font.read(notify=self.height)
         self.height.set(linespace(f) * 1.25)
@@ -73,7 +86,7 @@ class TextLayout:
             prev_font = self.previous.font.read(notify=self.x)
             prev_width = self.previous.width.read(notify=self.x)
             self.x.set(
-                prev_x + prev_font.measureText(' ') + prev_width)
+                prev_x + measure_text(prev_font, ' ') + prev_width)
         else:
             self.x.copy(self.parent.x)
 
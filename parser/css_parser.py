@@ -1,4 +1,5 @@
 from parser.html_parser import *
+from parser.css_values import *
 
 def cascade_priority(rule):
     media, selector, body = rule
@@ -7,19 +8,34 @@ def cascade_priority(rule):
 class TagSelector:
     def __init__(self, tag):
         self.tag = tag
-        self.priority = 1
+        self.priority = 0 if tag == "*" else 1
 
-    def matches(self, node):
-        return isinstance(node, Element) and self.tag == node.tag
+    def matches(self, node, ancestors=None):
+        return isinstance(node, Element) and \
+            (self.tag == node.tag or self.tag == "*")
     
+class IdSelector:
+    def __init__(self, id):
+        self.id = id
+        self.priority = 100
+
+    def matches(self, node, ancestors=None):
+        return isinstance(node, Element) and \
+            node.attributes.get("id") == self.id
+
 class DescendantSelector:
     def __init__(self, ancestor, descendant):
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority
+        self.ancestor_hashes = [
+            bloom_hash(key) for key in selector_keys(ancestor)]
     
-    def matches(self, node):
+    def matches(self, node, ancestors=None):
         if not self.descendant.matches(node): return False
+        if ancestors and \
+            not ancestors.might_contain_all(self.ancestor_hashes):
+            return False
         while node.parent:
             if self.ancestor.matches(node.parent): return True
             node = node.parent
@@ -31,7 +47,7 @@ class PseudoclassSelector:
         self.base = base
         self.priority = self.base.priority
 
-    def matches(self, node):
+    def matches(self, node, ancestors=None):
         if not self.base.matches(node):
             return False
         if self.pseudoclass == "focus":
@@ -42,6 +58,155 @@ class PseudoclassSelector:
     def __repr__(self):
         return "PseudoclassSelector({}, {})".format(self.pseudoclass, self.base)
 
+BLOOM_BITS = 12
+BLOOM_MASK = (1 << BLOOM_BITS) - 1
+
+def bloom_hash(key):
+    h = hash(key)
+    return (h & BLOOM_MASK, (h >> BLOOM_BITS) & BLOOM_MASK)
+
+def node_keys(node):
+    if "id" in node.attributes:
+        return [node.tag, "#" + node.attributes["id"]]
+    return [node.tag]
+
+# 选择器要求祖先上必须出现的标签名和id
+def selector_keys(selector):
+    if isinstance(selector, TagSelector):
+        return [] if selector.tag == "*" else [selector.tag]
+    elif isinstance(selector, IdSelector):
+        return ["#" + selector.id]
+    elif isinstance(selector, DescendantSelector):
+        return selector_keys(selector.ancestor) + \
+            selector_keys(selector.descendant)
+    else:
+        return selector_keys(selector.base)
+
+def selector_pseudoclasses(selector):
+    if isinstance(selector, DescendantSelector):
+        return selector_pseudoclasses(selector.ancestor) + \
+            selector_pseudoclasses(selector.descendant)
+    elif isinstance(selector, PseudoclassSelector):
+        return [selector.pseudoclass] + selector_pseudoclasses(selector.base)
+    else:
+        return []
+
+# 祖先元素的计数布隆过滤器，遍历时进入节点push、离开节点pop
+# 过滤器说没有的祖先一定不存在，后代选择器可以直接判定不匹配
+class AncestorFilter:
+    def __init__(self):
+        self.counts = [0] * (1 << BLOOM_BITS)
+
+    @classmethod
+    def for_node(cls, node):
+        ancestors = cls()
+        node = node.parent
+        while node:
+            ancestors.push(node)
+            node = node.parent
+        return ancestors
+
+    def push(self, node):
+        if not isinstance(node, Element): return
+        for key in node_keys(node):
+            a, b = bloom_hash(key)
+            self.counts[a] += 1
+            self.counts[b] += 1
+
+    def pop(self, node):
+        if not isinstance(node, Element): return
+        for key in node_keys(node):
+            a, b = bloom_hash(key)
+            self.counts[a] -= 1
+            self.counts[b] -= 1
+
+    def might_contain_all(self, hashes):
+        for a, b in hashes:
+            if not self.counts[a] or not self.counts[b]:
+                return False
+        return True
+
+# 按最右边的简单选择器把规则分桶，样式计算时每个节点只检查可能匹配的规则
+class RuleSet:
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=cascade_priority)
+        self.tags = {}
+        self.ids = {}
+        self.pseudoclasses = {}
+        self.universal = []
+        for order, rule in enumerate(self.rules):
+            self.bucket_for(rule[1]).append((order, rule))
+
+        # 失效集合：焦点变化和配色切换时只需要重算这些规则可能影响的属性
+        self.focus_targets = {}
+        self.focus_descendant_properties = set()
+        self.media_rules = []
+        for media, selector, body in self.rules:
+            if media:
+                self.media_rules.append((media, selector, body))
+            self.record_focus(selector, body)
+
+    def record_focus(self, selector, body):
+        rightmost = selector
+        if isinstance(selector, DescendantSelector):
+            rightmost = selector.descendant
+            if "focus" in selector_pseudoclasses(selector.ancestor):
+                self.focus_descendant_properties.update(body)
+        if isinstance(rightmost, PseudoclassSelector) and \
+            rightmost.pseudoclass == "focus":
+            base = rightmost.base
+            if isinstance(base, IdSelector):
+                key = "#" + base.id
+            else:
+                key = base.tag
+            self.focus_targets.setdefault(key, set()).update(body)
+
+    # 焦点变化时节点自身要重算的属性
+    def focus_properties(self, node):
+        properties = set()
+        for key in node_keys(node) + ["*"]:
+            properties.update(self.focus_targets.get(key, ()))
+        return properties
+
+    def bucket_for(self, selector):
+        pseudoclass = None
+        while not isinstance(selector, TagSelector) and \
+            not isinstance(selector, IdSelector):
+            if isinstance(selector, DescendantSelector):
+                selector = selector.descendant
+            else:
+                pseudoclass = selector.pseudoclass
+                selector = selector.base
+        if pseudoclass:
+            return self.pseudoclasses.setdefault(pseudoclass, [])
+        elif isinstance(selector, IdSelector):
+            return self.ids.setdefault(selector.id, [])
+        elif selector.tag == "*":
+            return self.universal
+        else:
+            return self.tags.setdefault(selector.tag, [])
+
+    # 返回按层叠顺序排好的候选规则
+    def candidates(self, node):
+        if not isinstance(node, Element): return []
+        buckets = []
+        if node.tag in self.tags:
+            buckets.append(self.tags[node.tag])
+        if "id" in node.attributes and node.attributes["id"] in self.ids:
+            buckets.append(self.ids[node.attributes["id"]])
+        if node.is_focused and "focus" in self.pseudoclasses:
+            buckets.append(self.pseudoclasses["focus"])
+        if self.universal:
+            buckets.append(self.universal)
+
+        if not buckets:
+            return []
+        elif len(buckets) == 1:
+            entries = buckets[0]
+        else:
+            entries = sorted([entry for bucket in buckets for entry in bucket])
+        return [rule for order, rule in entries]
+
 class CSSParser:
     def __init__(self, s):
         self.s = s
@@ -92,7 +257,11 @@ class CSSParser:
         return out
     
     def simple_selector(self):
-        out = TagSelector(self.word().casefold())
+        word = self.word()
+        if word.startswith("#"):
+            out = IdSelector(word[1:])
+        else:
+            out = TagSelector(word.casefold())
         if self.i < len(self.s) and self.s[self.i] == ":":
             self.literal(":")
             pseudoclass = self.word().casefold()
@@ -161,7 +330,7 @@ class CSSParser:
             cur = self.s[self.i]
             if cur == "'":
                 in_quote = not in_quote
-            if cur.isalnum() or cur in ",/#-.%()\"'" \
+            if cur.isalnum() or cur in ",/#-.%()\"'*" \
                 or (in_quote and cur == ':'):
                 self.i += 1
             else:
@@ -174,11 +343,3 @@ class CSSParser:
         if not (self.i < len(self.s) and self.s[self.i] == literal):
             raise Exception("Parsing error")
         self.i += 1
-
-def parse_transform(transform_str):
-    if transform_str.find('translate(') < 0:
-        return None
-    left_paren = transform_str.find('(')
-    right_paren = transform_str.find(')')
-    (x_px, y_px) = transform_str[left_paren + 1:right_paren].split(",")
-    return (float(x_px[:-2]), float(y_px[:-2]))
\ No newline at end of file
@@ -0,0 +1,130 @@
+import skia
+from setting.constant import REFRESH_RATE_SEC
+
+NAMED_COLORS = {
+    "black": "#000000",
+    "gray":  "#808080",
+    "white": "#ffffff",
+    "red":   "#ff0000",
+    "green": "#00ff00",
+    "blue":  "#0000ff",
+    "lightblue": "#add8e6",
+    "lightgreen": "#90ee90",
+    "orange": "#ffa500",
+    "orangered": "#ff4500",
+}
+
+def parse_color(color):
+    if isinstance(color, Color):
+        return color.color
+    return typed_value("color", color).color
+
+def parse_color_string(color):
+    if color.startswith("#") and len(color) == 7:
+        r = int(color[1:3], 16)
+        g = int(color[3:5], 16)
+        b = int(color[5:7], 16)
+        return skia.Color(r, g, b)
+    elif color.startswith("#") and len(color) == 9:
+        r = int(color[1:3], 16)
+        g = int(color[3:5], 16)
+        b = int(color[5:7], 16)
+        a = int(color[7:9], 16)
+        return skia.Color(r, g, b, a)
+    elif color in NAMED_COLORS:
+        return parse_color_string(NAMED_COLORS[color])
+    else:
+        return skia.ColorBLACK
+
+def parse_transform(transform_str):
+    if transform_str.find('translate(') < 0:
+        return None
+    left_paren = transform_str.find('(')
+    right_paren = transform_str.find(')')
+    (x_px, y_px) = transform_str[left_paren + 1:right_paren].split(",")
+    return (float(x_px[:-2]), float(y_px[:-2]))
+
+def parse_outline(outline_str):
+    if not outline_str: return None
+    values = outline_str.split(" ")
+    if len(values) != 3: return None
+    if values[1] != "solid": return None
+    return int(values[0][:-2]), Color(values[2])
+
+def parse_transition(value):
+    properties = {}
+    if not value: return properties
+    for item in value.split(","):
+        property, duration = item.split(" ", 1)
+        frames = int(float(duration[:-1]) / REFRESH_RATE_SEC)
+        properties[property] = frames
+    return properties
+
+# 计算值的类型都继承自str，和字符串比较、作为字典键都照旧，
+# 解析结果在构造时算好，排版和绘制直接读取数字
+class Length(str):
+    def __init__(self, value):
+        self.px = float(value[:-2]) if value.endswith("px") else None
+
+class Number(str):
+    def __init__(self, value):
+        self.value = float(value)
+
+class Color(str):
+    def __init__(self, value):
+        self.color = parse_color_string(value)
+
+class Transform(str):
+    def __init__(self, value):
+        self.translation = parse_transform(value)
+
+class Outline(str):
+    def __init__(self, value):
+        self.outline = parse_outline(value)
+
+class Transition(str):
+    def __init__(self, value):
+        self.frames = parse_transition(value)
+
+# strict和content是几种包含的简写
+class Containment(str):
+    def __init__(self, value):
+        keywords = set(value.split())
+        if "strict" in keywords:
+            keywords |= {"size", "layout", "paint"}
+        if "content" in keywords:
+            keywords |= {"layout", "paint"}
+        self.size = "size" in keywords
+        self.layout = "layout" in keywords
+        self.paint = "paint" in keywords
+
+VALUE_TYPES = {
+    "font-size": Length,
+    "border-radius": Length,
+    "opacity": Number,
+    "color": Color,
+    "background-color": Color,
+    "transform": Transform,
+    "outline": Outline,
+    "transition": Transition,
+    "contain": Containment,
+    "height": Length,
+}
+
+TYPED_VALUE_CACHE = {}
+TYPED_VALUE_CACHE_ENTRIES = 4096
+
+# 同一个属性的同一个字符串只解析一次
+def typed_value(property, value):
+    if value is None or property not in VALUE_TYPES:
+        return value
+    if type(value) == VALUE_TYPES[property]:
+        return value
+    key = (property, value)
+    typed = TYPED_VALUE_CACHE.get(key)
+    if typed is None:
+        typed = VALUE_TYPES[property](value)
+        if len(TYPED_VALUE_CACHE) >= TYPED_VALUE_CACHE_ENTRIES:
+            TYPED_VALUE_CACHE.clear()
+        TYPED_VALUE_CACHE[key] = typed
+    return typed
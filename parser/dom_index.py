@@ -0,0 +1,185 @@
+from parser.css_parser import *
+from utils.util import tree_to_list
+
+# 这些属性变化时要更新索引
+INDEXED_ATTRIBUTES = ["id", "tabindex", "contenteditable"]
+FOCUSABLE_TAGS = ["input", "button", "a"]
+
+# 可能获得焦点的元素，是否真的能聚焦还要再用is_focusable判断
+def is_focus_candidate(node):
+    return node.tag in FOCUSABLE_TAGS \
+        or "tabindex" in node.attributes \
+        or "contenteditable" in node.attributes
+
+def insert(buckets, key, node):
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = {}
+    bucket[node] = None
+
+def discard(buckets, key, node):
+    bucket = buckets.get(key)
+    if bucket is None: return
+    bucket.pop(node, None)
+    if not bucket: del buckets[key]
+
+# 按文档顺序排列节点：比较从根到节点的子节点下标路径，
+# 每个父节点的下标表只建一次，只需要访问这些节点的祖先
+def document_order(nodes):
+    indices = {}
+    def position(node):
+        path = []
+        while node.parent:
+            parent = node.parent
+            if parent not in indices:
+                indices[parent] = dict([
+                    (child, i) for i, child in enumerate(parent.children)
+                ])
+            path.append(indices[parent][node])
+            node = parent
+        path.reverse()
+        return path
+    return dict.fromkeys(sorted(nodes, key=position))
+
+# 文档的元素索引：标签名、id和可聚焦元素到节点的映射
+# 每个桶用dict充当有序集合，保持文档顺序
+class DOMIndex:
+    def __init__(self):
+        self.root = None
+        self.tags = {}
+        self.ids = {}
+        self.focusable = {}
+        # 插入到文档中间的节点先排在桶的末尾，记下这些桶，查询时只重排它们
+        self.unsorted_tags = set()
+        self.unsorted_ids = set()
+        self.focusable_unsorted = False
+
+    def add(self, node):
+        if not isinstance(node, Element): return
+        insert(self.tags, node.tag, node)
+        if "id" in node.attributes:
+            insert(self.ids, node.attributes["id"], node)
+        if is_focus_candidate(node):
+            self.focusable[node] = None
+
+    def remove(self, node):
+        if not isinstance(node, Element): return
+        discard(self.tags, node.tag, node)
+        if "id" in node.attributes:
+            discard(self.ids, node.attributes["id"], node)
+        self.focusable.pop(node, None)
+
+    def add_tree(self, tree):
+        for node in tree_to_list(tree, []):
+            if not isinstance(node, Element): continue
+            self.add(node)
+            self.unsorted_tags.add(node.tag)
+            if "id" in node.attributes:
+                self.unsorted_ids.add(node.attributes["id"])
+            if is_focus_candidate(node):
+                self.focusable_unsorted = True
+
+    def remove_tree(self, tree):
+        for node in tree_to_list(tree, []):
+            self.remove(node)
+
+    def set_attribute(self, node, attr, value):
+        if attr not in INDEXED_ATTRIBUTES or \
+            node not in self.tags.get(node.tag, {}):
+            node.attributes[attr] = value
+            return
+        # 只有这个属性对应的桶会变，标签桶不用动
+        if attr == "id":
+            if "id" in node.attributes:
+                discard(self.ids, node.attributes["id"], node)
+            node.attributes[attr] = value
+            insert(self.ids, value, node)
+            self.unsorted_ids.add(value)
+            return
+        was_candidate = is_focus_candidate(node)
+        node.attributes[attr] = value
+        if not was_candidate:
+            self.focusable[node] = None
+            self.focusable_unsorted = True
+
+    # 从根开始建立整个索引
+    def rebuild(self):
+        self.tags = {}
+        self.ids = {}
+        self.focusable = {}
+        self.unsorted_tags = set()
+        self.unsorted_ids = set()
+        self.focusable_unsorted = False
+        if self.root:
+            for node in tree_to_list(self.root, []):
+                self.add(node)
+
+    def by_tag(self, tag):
+        if tag in self.unsorted_tags:
+            self.unsorted_tags.discard(tag)
+            if tag in self.tags:
+                self.tags[tag] = document_order(self.tags[tag])
+        return list(self.tags.get(tag, ()))
+
+    def by_id(self, id):
+        if id in self.unsorted_ids:
+            self.unsorted_ids.discard(id)
+            if id in self.ids:
+                self.ids[id] = document_order(self.ids[id])
+        return list(self.ids.get(id, ()))
+
+    def focusable_nodes(self):
+        if self.focusable_unsorted:
+            self.focusable_unsorted = False
+            self.focusable = document_order(self.focusable)
+        return list(self.focusable)
+
+    # 用选择器最右边的简单选择器缩小候选范围
+    def query(self, selector):
+        key = selector
+        while not isinstance(key, TagSelector) and \
+            not isinstance(key, IdSelector):
+            if isinstance(key, DescendantSelector):
+                key = key.descendant
+            else:
+                key = key.base
+        if isinstance(key, IdSelector):
+            candidates = self.by_id(key.id)
+        elif key.tag == "*":
+            candidates = tree_to_list(self.root, []) if self.root else []
+        else:
+            candidates = self.by_tag(key.tag)
+
+        # 文档里根本没有要求的祖先标签或id时直接返回
+        if isinstance(selector, DescendantSelector):
+            for key in selector_keys(selector.ancestor):
+                if key.startswith("#"):
+                    if not self.ids.get(key[1:]): return []
+                elif not self.tags.get(key):
+                    return []
+
+        # 候选节点较多时，带着祖先过滤器遍历一次文档比逐个向上查找祖先更快
+        if isinstance(selector, DescendantSelector) and \
+            len(candidates) * 8 > self.element_count():
+            return self.match_tree(selector, set(candidates))
+        return [node for node in candidates if selector.matches(node)]
+
+    def element_count(self):
+        return sum([len(bucket) for bucket in self.tags.values()])
+
+    def match_tree(self, selector, candidates):
+        ancestors = AncestorFilter()
+        nodes = []
+        stack = [(self.root, False)]
+        while stack:
+            node, leaving = stack.pop()
+            if leaving:
+                ancestors.pop(node)
+                continue
+            if node in candidates and selector.matches(node, ancestors):
+                nodes.append(node)
+            if node.children:
+                ancestors.push(node)
+                stack.append((node, True))
+                stack.extend([(child, False) for child in node.children[::-1]])
+        return nodes
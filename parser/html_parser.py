@@ -1,19 +1,37 @@
+import re
+import sys
+
+# 文本节点没有子节点，所有文本节点共用同一个空元组
+NO_CHILDREN = ()
+
 class Text:
+    __slots__ = [
+        "text", "children", "parent", "style", "animations",
+        "is_focused", "layout_object", "blend_op",
+    ]
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
+        self.children = NO_CHILDREN
         self.parent = parent
 
         self.style = None
-        self.animations = {}
+        self.animations = None
 
         self.is_focused = False
         self.layout_object = None
+        self.blend_op = None
     
     def __repr__(self):
         return repr(self.text)
 
 class Element:
+    __slots__ = [
+        "tag", "attributes", "children", "parent", "style", "animations",
+        "is_focused", "layout_object", "blend_op",
+        "image", "encoded_data", "frame",
+    ]
+
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.attributes = attributes
@@ -21,67 +39,62 @@ class Element:
         self.parent = parent
 
         self.style = None
-        self.animations = {}
+        self.animations = None
 
         self.is_focused = False
         self.layout_object = None
+        self.blend_op = None
+
+        self.image = None
+        self.encoded_data = None
+        self.frame = None
 
     def __repr__(self):
         return "<" + self.tag + ">"
+
+# 子节点可能是列表，也可能是压缩后的元组
+def append_child(parent, child):
+    if isinstance(parent.children, tuple):
+        parent.children += (child,)
+    else:
+        parent.children.append(child)
+
+# 解析完成后把子节点列表换成元组，省掉列表预留的空间
+def compact_children(root):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Text): continue
+        node.children = tuple(node.children)
+        stack.extend(node.children)
     
+TAG_NAME = re.compile(r"/?[^\s/=\"']*")
+ATTRIBUTE = re.compile(
+    r"""([^\s/="']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"']*)))?""")
+
 class AttributeParser:
     def __init__(self, s):
         self.s = s
-        self.i = 0
-
-    def whitespace(self):
-        while self.i < len(self.s) and self.s[self.i].isspace():
-            self.i += 1
-
-    def literal(self, literal):
-        if self.i < len(self.s) and self.s[self.i] == literal:
-            self.i += 1
-            return True
-        return False
-
-    def word(self, allow_quotes=False):
-        start = self.i
-        in_quote = False
-        quoted = False
-        while self.i < len(self.s):
-            cur = self.s[self.i]
-            if not cur.isspace() and cur not in "=\"\'":
-                self.i += 1
-            elif allow_quotes and cur in "\"\'":
-                in_quote = not in_quote
-                quoted = True
-                self.i += 1
-            elif in_quote and (cur.isspace() or cur == "="):
-                self.i += 1
-            else:
-                break
-        if self.i == start:
-            self.i = len(self.s)
-            return ""
-        if quoted:
-            return self.s[start+1:self.i-1]
-        return self.s[start:self.i]
 
     def parse(self):
+        s = self.s.strip()
+        tag_match = TAG_NAME.match(s)
+        tag = sys.intern(tag_match.group().casefold())
         attributes = {}
-        tag = None
-
-        tag = self.word().casefold()
-        while self.i < len(self.s):
-            self.whitespace()
-            key = self.word()
-            if self.literal("="):
-                value = self.word(allow_quotes=True) 
-                attributes[key.casefold()] = value
+        if tag_match.end() == len(s): return (tag, attributes)
+        for match in ATTRIBUTE.finditer(s, tag_match.end()):
+            key, double_quoted, single_quoted, bare = match.groups()
+            if double_quoted != None:
+                value = double_quoted
+            elif single_quoted != None:
+                value = single_quoted
             else:
-                attributes[key.casefold()] = ""
+                value = bare or ""
+            attributes[sys.intern(key.casefold())] = value
         return (tag, attributes)
 
+DELIMITER = re.compile("[<>]")
+
 class HTMLParser:
 
     SELF_CLOSING_TAGS = [
@@ -94,27 +107,55 @@ class HTMLParser:
         "link", "meta", "title", "style", "script",
     ]
 
-    def __init__(self, body):
+    def __init__(self, body="", compact=False, index=None):
         self.body = body
+        self.compact = compact
+        self.index = index
         self.unfinished = []
+        self.root = None
+        self.new_nodes = []
+
+        # 还没遇到分隔符的文本片段，遇到分隔符时才拼起来
+        self.pending = []
+        self.in_tag = False
 
     def parse(self):
-        text = ""
-        in_tag = False
-        for c in self.body:
-            if c == "<":
-                in_tag = True
-                if text: self.add_text(text)
-                text = ""
-            elif c == ">":
-                in_tag = False
-                if text: self.add_tag(text)
-                text = ""
+        self.feed(self.body)
+        return self.close()
+
+    # 增量解析：每次喂入一段文本，未完成的标签/文本留到下次。
+    # 只扫描新的一段，很长的文本或标签分很多段到达时也不会反复复制
+    def feed(self, chunk):
+        i = 0
+        for match in DELIMITER.finditer(chunk):
+            j = match.start()
+            if self.pending:
+                self.pending.append(chunk[i:j])
+                token = "".join(self.pending)
+                self.pending = []
+            else:
+                token = chunk[i:j]
+            if chunk[j] == "<":
+                self.in_tag = True
+                if token: self.add_text(token)
             else:
-                text += c
-        if not in_tag and text:
+                self.in_tag = False
+                if token: self.add_tag(token)
+            i = j + 1
+        if i < len(chunk):
+            self.pending.append(chunk[i:])
+
+    def close(self):
+        text = "".join(self.pending)
+        if not self.in_tag and text:
             self.add_text(text)
+        self.pending = []
         return self.finish()
+
+    def pop_new_nodes(self):
+        nodes = self.new_nodes
+        self.new_nodes = []
+        return nodes
     
     def add_text(self, text):
         if text.isspace(): return
@@ -123,6 +164,7 @@ class HTMLParser:
         parent = self.unfinished[-1]
         node = Text(text, parent)
         parent.children.append(node)
+        self.new_nodes.append(node)
 
     def add_tag(self, tag):
         tag, attributes = self.get_attributes(tag)
@@ -130,26 +172,34 @@ class HTMLParser:
         if tag.startswith("!"): return
         self.implicit_tags(tag)
 
+        # 节点在开始标签处就挂到父节点上，这样解析到一半的树也能渲染
         if tag.startswith("/"):
             if len(self.unfinished) == 1: return
-
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.unfinished.pop()
         elif tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
             parent.children.append(node)
+            self.new_nodes.append(node)
+            if self.index: self.index.add(node)
         else:
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent)
+            if parent:
+                parent.children.append(node)
+            else:
+                self.root = node
+                if self.index: self.index.root = node
             self.unfinished.append(node)
+            self.new_nodes.append(node)
+            if self.index: self.index.add(node)
 
     def get_attributes(self, text):
         (tag, attributes) = AttributeParser(text).parse()
         return tag, attributes
     
     def implicit_tags(self, tag):
+        if len(self.unfinished) > 2: return
         while True:
             open_tags = [node.tag for node in self.unfinished]
         
@@ -169,9 +219,7 @@ class HTMLParser:
         if not self.unfinished:
             self.implicit_tags(None)
 
-        while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
-
-        return self.unfinished.pop()
\ No newline at end of file
+        self.unfinished = []
+        if self.compact and self.root:
+            compact_children(self.root)
+        return self.root
\ No newline at end of file
@@ -78,9 +78,7 @@ class JSContext:
         frame = self.tab.window_id_to_frame[window_id]
         self.throw_if_cross_origin(frame)
         selector = CSSParser(selector_text).selector()
-        nodes = [node for node
-                in tree_to_list(frame.nodes, [])
-                 if selector.matches(node)]
+        nodes = frame.index.query(selector)
         return [self.get_handle(node) for node in nodes]
     
     def getAttribute(self, handle, attr):
@@ -92,13 +90,19 @@ class JSContext:
         frame = self.tab.window_id_to_frame[window_id]        
         self.throw_if_cross_origin(frame)
         elt = self.handle_to_node[handle]
-        elt.attributes[attr] = value
+        frame.index.set_attribute(elt, attr, value)
         obj = elt.layout_object
         if isinstance(obj, IframeLayout) or \
            isinstance(obj, ImageLayout):
             if attr == "width" or attr == "height":
                 obj.width.mark()
                 obj.height.mark()
+        # id选择器可能匹配它，也可能作为后代选择器的祖先匹配它的子孙；
+        # 样式共享的祖先链编号在重算样式时按新的id重新生成
+        if attr == "id":
+            for node in tree_to_list(elt, []):
+                dirty_style(node)
+        frame.invalidate_paint(elt)
         self.tab.set_needs_render_all_frames()
     
     def dispatch_event(self, type, elt, window_id):
@@ -115,22 +119,29 @@ class JSContext:
             "<html><body>" + s + "</body></html>").parse()
         new_nodes = doc.children[0].children
         elt = self.handle_to_node[handle]
+        for child in elt.children:
+            frame.index.remove_tree(child)
         elt.children = new_nodes
         for child in elt.children:
             child.parent = elt
-        obj = elt.layout_object
-        if obj:
-            while not isinstance(obj, BlockLayout):
-                obj = obj.parent
-            obj.children.mark()
+            frame.index.add_tree(child)
+        mark_layout_children(elt)
         frame.set_needs_render()
 
     def style_set(self, handle, s, window_id):
         frame = self.tab.window_id_to_frame[window_id]
         self.throw_if_cross_origin(frame)
         elt = self.handle_to_node[handle]
+        old_pairs = parse_inline_style(elt.attributes.get('style', ""))
+        new_pairs = parse_inline_style(s)
         elt.attributes['style'] = s
-        dirty_style(elt)
+        # 只让值真正变化的属性失效
+        changed = [
+            property for property in set(old_pairs) | set(new_pairs)
+            if old_pairs.get(property) != new_pairs.get(property)
+        ]
+        if not changed: return
+        dirty_style(elt, changed)
         frame.set_needs_render()
 
     def dispatch_xhr_onload(self, out, handle, window_id):
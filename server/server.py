@@ -2,6 +2,7 @@ import socket
 import urllib.parse
 import random
 import html
+import gzip
 
 ENTRIES = [
     ("No names. We are nameless!", "cerealkiller"),
@@ -141,16 +142,19 @@ def handle_connection(conx):
     session = SESSIONS.setdefault(token, {})
     status, body = do_request(session, method, url, headers, body)
     # 返回Response
+    payload = body.encode("utf8")
     response = "HTTP/1.0 {}\r\n".format(status)
-    response += "Content-Length: {}\r\n".format(
-        len(body.encode("utf8")))
+    if "gzip" in headers.get("accept-encoding", ""):
+        payload = gzip.compress(payload)
+        response += "Content-Encoding: gzip\r\n"
+    response += "Content-Length: {}\r\n".format(len(payload))
     if 'cookie' not in headers:
         template = "Set-Cookie: token={}; SameSite=Lax\r\n"
         response += template.format(token)
     csp = "default-src http://localhost:8000"
     response += "Content-Security-Policy: {}\r\n".format(csp)
-    response += "\r\n" + body
-    conx.send(response.encode('utf8'))
+    response += "\r\n"
+    conx.send(response.encode('utf8') + payload)
     conx.close()
 
 if __name__ == "__main__":
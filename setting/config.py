@@ -1,6 +1,6 @@
 from parser.css_parser import CSSParser
 
-DEFAULT_STYLE_SHEET = CSSParser(open("setting/browser.css").read()).parse()
+DEFAULT_STYLE_SHEET = tuple(CSSParser(open("setting/browser.css").read()).parse())
 
 class Config:
     dark_mode = False
\ No newline at end of file
@@ -17,6 +17,34 @@ REFRESH_RATE_SEC = .033
 
 BROKEN_IMAGE = skia.Image.open("resource/jane.png")
 
+# 样式共享缓存最多保存的计算结果数量
+STYLE_SHARING_ENTRIES = 4096
+
+# style属性解析缓存最多保存的条目数量
+INLINE_STYLE_CACHE_ENTRIES = 1024
+
+# 文字宽度缓存最多保存的条目数量
+TEXT_MEASURE_CACHE_ENTRIES = 16384
+
+# 字体对象缓存最多保存的字号数量
+FONT_CACHE_ENTRIES = 256
+
+# ProtectedField的依赖边不超过这个数量时用元组保存
+SMALL_INVALIDATIONS = 8
+
+# 同一行里同一文本节点的单词合成一个TextLayout
+TEXT_RUNS = True
+
+# 视口下方超过一屏的块先只估算高度，滚动到附近再排版
+LAZY_LAYOUT = True
+LAZY_LAYOUT_MARGIN = HEIGHT
+
+# 估算未排版文字宽度用的样本
+ESTIMATE_SAMPLE_TEXT = "the quick brown fox jumps over a lazy dog "
+
+# 解析完成后用元组保存DOM子节点
+COMPACT_DOM = True
+
 IFRAME_WIDTH_PX = 300
 IFRAME_HEIGHT_PX = 150
 
@@ -27,5 +55,6 @@ CSS_PROPERTIES = {
     "transform": "none", "mix-blend-mode": None,
     "border-radius": "0px", "overflow": "visible",
     "outline": "none", "background-color": "transparent",
-    "image-rendering": "auto",
+    "image-rendering": "auto", "content-visibility": "visible",
+    "contain": "none", "height": "auto",
 }
@@ -6,11 +6,26 @@ from setting.config import *
 from display.paint_command import *
 from display.visual_effect import *
 
-def dirty_style(node):
-    if not node.style:
+def dirty_style(node, properties=None):
+    if not node.style or isinstance(node, Text):
         return
-    for property, value in node.style.items():
-        value.mark()
+    if properties is None:
+        properties = node.style.keys()
+    for property in properties:
+        if property in node.style:
+            node.style[property].mark()
+
+INLINE_STYLE_CACHE = {}
+
+# style属性的文本到声明的缓存，返回的字典是共享的，不能修改
+def parse_inline_style(text):
+    pairs = INLINE_STYLE_CACHE.get(text)
+    if pairs is None:
+        pairs = CSSParser(text).body()
+        if len(INLINE_STYLE_CACHE) >= INLINE_STYLE_CACHE_ENTRIES:
+            INLINE_STYLE_CACHE.clear()
+        INLINE_STYLE_CACHE[text] = pairs
+    return pairs
 
 def init_style(node):
     node.style = dict([
@@ -19,63 +34,156 @@ def init_style(node):
             for property in CSS_PROPERTIES
         ])
 
-def style(node, rules, frame):
+def default_field(property):
+    field = ProtectedField(None, property, None, [])
+    field.set(typed_value(property, CSS_PROPERTIES[property]))
+    return field
+
+# 文本节点不会被任何规则匹配，样式只由父元素决定：
+# 可继承属性直接用父元素的字段，其余属性都是不会变的默认值
+TEXT_DEFAULT_STYLE = dict([
+    (property, default_field(property))
+    for property in CSS_PROPERTIES
+    if property not in INHERITED_PROPERTIES
+])
+
+def init_text_style(node):
+    node.style = TEXT_DEFAULT_STYLE.copy()
+    for property in INHERITED_PROPERTIES:
+        node.style[property] = node.parent.style[property]
+
+# 样式共享缓存：标签、id、焦点状态和祖先链都相同，内联样式和继承值也相同的元素
+# 层叠结果一定相同，兄弟和堂兄弟元素可以共用同一份计算结果
+class StyleSharingCache:
+    def __init__(self, max_entries=STYLE_SHARING_ENTRIES):
+        self.chains = {}
+        self.next_chain = 0
+        self.styles = {}
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    # 给“节点+祖先链”分配一个编号，编号只增不减，清空后也不会重复
+    def chain(self, node, parent_chain):
+        key = (node.tag, node.attributes.get("id"),
+            node.is_focused, parent_chain)
+        chain = self.chains.get(key)
+        if chain is None:
+            if len(self.chains) >= self.max_entries:
+                self.chains = {}
+            chain = self.chains[key] = self.next_chain
+            self.next_chain += 1
+        return chain
+
+    def chain_for(self, node):
+        if not node: return None
+        return self.chain(node, self.chain_for(node.parent))
+
+    def get(self, key):
+        computed = self.styles.get(key)
+        if computed is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return computed
+
+    def put(self, key, computed):
+        if len(self.styles) >= self.max_entries:
+            self.styles = {}
+        self.styles[key] = computed
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.styles),
+        }
+
+def cascade(node, rules, ancestors, parent_values):
+    new_style = CSS_PROPERTIES.copy()
+    for property, value in zip(INHERITED_PROPERTIES, parent_values):
+        new_style[property] = value
+    for media, selector, body in rules.candidates(node):
+        if media:
+            if (media == 'dark') != Config.dark_mode: continue
+        if not selector.matches(node, ancestors): continue
+        for property, value in body.items():
+            new_style[property] = value
+    if 'style' in node.attributes:
+        pairs = parse_inline_style(node.attributes['style'])
+        for property, value in pairs.items():
+            new_style[property] = value
+    if new_style["font-size"].endswith("%"):
+        parent_font_size = dict(zip(INHERITED_PROPERTIES, parent_values))["font-size"]
+        node_pct = float(new_style["font-size"][:-1]) / 100
+        parent_px = parent_font_size.px
+        new_style["font-size"] = str(node_pct * parent_px) + "px"
+    for property, value in new_style.items():
+        new_style[property] = typed_value(property, value)
+    return new_style
+
+def style(node, rules, frame, ancestors=None, parent_chain=None):
+    if isinstance(node, Text):
+        if not node.style:
+            init_text_style(node)
+        return
+    cache = frame.style_cache
+    if ancestors is None:
+        ancestors = AncestorFilter.for_node(node)
+        parent_chain = cache.chain_for(node.parent)
+    chain = cache.chain(node, parent_chain)
     if not node.style:
         init_style(node)
     needs_style = any([field.dirty for field in node.style.values()])
 
     if needs_style:
-        old_style = dict([
-            (property, field.value)
-            for property, field in node.style.items()
-        ])
-        new_style = CSS_PROPERTIES.copy()
-        for property, default_value in INHERITED_PROPERTIES.items():
-            if node.parent:
-                parent_field = node.parent.style[property]
-                parent_value = parent_field.read(notify=node.style[property])
-                new_style[property] = parent_value
-            else:
-                new_style[property] = default_value
-        for media, selector, body in rules:
-            if media:
-                if (media == 'dark') != Config.dark_mode: continue
-            if not selector.matches(node): continue
-            for property, value in body.items():
-                new_style[property] = value
-        if isinstance(node, Element) and 'style' in node.attributes:
-            pairs = CSSParser(node.attributes['style']).body()
-            for property, value in pairs.items():
-                new_style[property] = value
-        if new_style["font-size"].endswith("%"):
-            if node.parent:
-                parent_field = node.parent.style["font-size"]
-                parent_font_size = \
-                    parent_field.read(notify=node.style["font-size"])
-            else:
-                parent_font_size = INHERITED_PROPERTIES["font-size"]
-            node_pct = float(new_style["font-size"][:-1]) / 100
-            parent_px = float(parent_font_size[:-2])
-            new_style["font-size"] = str(node_pct * parent_px) + "px"
-        if old_style:
+        frame.restyled_nodes += 1
+        frame.invalidate_paint(node)
+        if node.parent:
+            parent_values = tuple([
+                node.parent.style[property].read(notify=node.style[property])
+                for property in INHERITED_PROPERTIES
+            ])
+        else:
+            parent_values = tuple([
+                typed_value(property, value)
+                for property, value in INHERITED_PROPERTIES.items()
+            ])
+        key = (chain, node.attributes.get("style"),
+            Config.dark_mode, parent_values)
+        new_style = cache.get(key)
+        if new_style is None:
+            new_style = cascade(node, rules, ancestors, parent_values)
+            cache.put(key, new_style)
+        if new_style["transition"]:
+            old_style = dict([
+                (property, field.value)
+                for property, field in node.style.items()
+            ])
+            new_style = new_style.copy()
             transitions = diff_styles(old_style, new_style)
             for property, (old_value, new_value, num_frames) in \
                 transitions.items():
                 if property == "opacity":
                     frame.set_needs_render()
                     animation = NumericAnimation(old_value, new_value, num_frames)
+                    if node.animations is None:
+                        node.animations = {}
                     node.animations[property] = animation
-                    new_style[property] = animation.animate()
+                    new_style[property] = \
+                        typed_value(property, animation.animate())
         for property, field in node.style.items():
             field.set(new_style[property])
 
+    if not node.children: return
+    ancestors.push(node)
     for child in node.children:
-        style(child, rules, frame)
+        style(child, rules, frame, ancestors, chain)
+    ancestors.pop(node)
 
 def diff_styles(old_style, new_style):
     transitions = {}
-    for property, num_frames in \
-        parse_transition(new_style.get("transition")).items():
+    for property, num_frames in new_style["transition"].frames.items():
         if property not in old_style: continue
         if property not in new_style: continue
         old_value = old_style[property]
@@ -86,22 +194,14 @@ def diff_styles(old_style, new_style):
 
     return transitions
 
-def parse_transition(value):
-    properties = {}
-    if not value: return properties
-    for item in value.split(","):
-        property, duration = item.split(" ", 1)
-        frames = int(float(duration[:-1]) / REFRESH_RATE_SEC)
-        properties[property] = frames
-    return properties
-
 def paint_visual_effects(node, cmds, rect):
-    opacity = float(node.style["opacity"].get())
+    opacity = node.style["opacity"].get().value
     blend_mode = node.style["mix-blend-mode"].get()
-    translation = parse_transform(node.style["transform"].get())
+    translation = node.style["transform"].get().translation
 
-    if node.style["overflow"].get() == "clip":
-        border_radius = float(node.style["border-radius"].get()[:-2])
+    if node.style["overflow"].get() == "clip" or \
+        node.style["contain"].get().paint:
+        border_radius = node.style["border-radius"].get().px
         if not blend_mode:
             blend_mode = "source-over"
         cmds = [Blend(1.0, "source-over", node,
@@ -112,14 +212,7 @@ def paint_visual_effects(node, cmds, rect):
     return [Transform(translation, rect, node, [blend_op])]
 
 def paint_outline(node, cmds, rect, zoom):
-    outline = parse_outline(node.style["outline"].get())
+    outline = node.style["outline"].get().outline
     if not outline: return
     thickness, color = outline
     cmds.append(DrawOutline(rect, color, dpx(thickness, zoom)))
-
-def parse_outline(outline_str):
-    if not outline_str: return None
-    values = outline_str.split(" ")
-    if len(values) != 3: return None
-    if values[1] != "solid": return None
-    return int(values[0][:-2]), values[2]
\ No newline at end of file
@@ -0,0 +1,42 @@
+import bisect
+
+# 命中测试用的空间索引：矩形按上边排序，线段树里记下每一段矩形最大的下边。
+# 点查询先二分出上边不超过它的前缀，再只进入下边可能够到它的段，
+# 命中k个矩形的查询是O(k log n)
+class SpatialIndex:
+    def __init__(self, entries):
+        order = sorted(range(len(entries)),
+            key=lambda i: entries[i][0].top())
+        self.tops = [entries[i][0].top() for i in order]
+        self.entries = [(i, entries[i][0], entries[i][1]) for i in order]
+
+        self.size = 1
+        while self.size < len(order):
+            self.size *= 2
+        self.bottoms = [float("-inf")] * (2 * self.size)
+        for leaf, (_, rect, _) in enumerate(self.entries):
+            self.bottoms[self.size + leaf] = rect.bottom()
+        for node in range(self.size - 1, 0, -1):
+            self.bottoms[node] = max(
+                self.bottoms[2 * node], self.bottoms[2 * node + 1])
+
+    # 和rect上下左右(含边界)都有重叠的(矩形, 条目)，按加入的顺序返回；
+    # 边界上算不算命中由调用者再精确判断
+    def query(self, rect):
+        end = bisect.bisect_right(self.tops, rect.bottom())
+        hits = []
+        stack = [(1, 0, self.size)]
+        while stack:
+            node, low, high = stack.pop()
+            if low >= end or self.bottoms[node] < rect.top(): continue
+            if high - low == 1:
+                index, bounds, item = self.entries[low]
+                if bounds.left() <= rect.right() and \
+                    bounds.right() >= rect.left():
+                    hits.append((index, bounds, item))
+                continue
+            middle = (low + high) // 2
+            stack.append((2 * node, low, middle))
+            stack.append((2 * node + 1, middle, high))
+        hits.sort(key=lambda hit: hit[0])
+        return [(bounds, item) for _, bounds, item in hits]
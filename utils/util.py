@@ -1,5 +1,8 @@
 import skia
-from parser.css_parser import parse_transform
+import threading
+from collections import OrderedDict
+from parser.css_values import *
+from setting.constant import TEXT_MEASURE_CACHE_ENTRIES, FONT_CACHE_ENTRIES
 from common.protected_field import *
 
 def print_tree(node, indent=0):
@@ -10,13 +13,17 @@ def print_tree(node, indent=0):
     for child in children:
         print_tree(child, indent + 2)
 
+# 用显式栈代替递归，深层的树也不会超出递归深度
 def tree_to_list(tree, list):
-    list.append(tree)
-    children = tree.children
-    if isinstance(children, ProtectedField):
-        children = children.get()
-    for child in children:
-        tree_to_list(child, list)
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        list.append(node)
+        children = node.children
+        if not children: continue
+        if isinstance(children, ProtectedField):
+            children = children.get()
+        stack.extend(children[::-1])
     return list
 
 def add_parent_pointers(nodes, parent=None):
@@ -29,38 +36,8 @@ def print_composited_layers(composited_layers):
     for layer in composited_layers:
         print("  " * 4 + str(layer))
 
-NAMED_COLORS = {
-    "black": "#000000",
-    "gray":  "#808080",
-    "white": "#ffffff",
-    "red":   "#ff0000",
-    "green": "#00ff00",
-    "blue":  "#0000ff",
-    "lightblue": "#add8e6",
-    "lightgreen": "#90ee90",
-    "orange": "#ffa500",
-    "orangered": "#ff4500",
-}
-
-def parse_color(color):
-    if color.startswith("#") and len(color) == 7:
-        r = int(color[1:3], 16)
-        g = int(color[3:5], 16)
-        b = int(color[5:7], 16)
-        return skia.Color(r, g, b)
-    elif color.startswith("#") and len(color) == 9:
-        r = int(color[1:3], 16)
-        g = int(color[3:5], 16)
-        b = int(color[5:7], 16)
-        a = int(color[7:9], 16)
-        return skia.Color(r, g, b, a)
-    elif color in NAMED_COLORS:
-        return parse_color(NAMED_COLORS[color])
-    else:
-        return skia.ColorBLACK
-
 def linespace(font):
-    metrics = font.getMetrics()
+    metrics = font_metrics(font)
     return metrics.fDescent - metrics.fAscent
 
 def map_translation(rect, translation, reversed=False):
@@ -79,10 +56,34 @@ def absolute_bounds_for_obj(obj):
     rect = skia.Rect.MakeXYWH(obj.x.get(), obj.y.get(), obj.width.get(), obj.height.get())
     cur = obj.node
     while cur:
-        rect = map_translation(rect, parse_transform(cur.style['transform'].get()))
+        rect = map_translation(rect, cur.style['transform'].get().translation)
         cur = cur.parent
     return rect
 
+# 一次算整棵布局树的绝对位置，每个DOM节点累积的平移只算一次
+def absolute_bounds_for_objs(objs):
+    translations = {}
+    bounds = []
+    for obj in objs:
+        (x, y) = accumulated_translation(obj.node, translations)
+        bounds.append(skia.Rect.MakeXYWH(obj.x.get() + x, obj.y.get() + y,
+            obj.width.get(), obj.height.get()))
+    return bounds
+
+def accumulated_translation(node, translations):
+    chain = []
+    while node is not None and node not in translations:
+        chain.append(node)
+        node = node.parent
+    (x, y) = translations[node] if node is not None else (0, 0)
+    for node in reversed(chain):
+        translation = node.style['transform'].get().translation
+        if translation:
+            x += translation[0]
+            y += translation[1]
+        translations[node] = (x, y)
+    return (x, y)
+
 def local_to_absolute(display_item, rect):
     while display_item.parent:
         rect = display_item.parent.map(rect)
@@ -119,9 +120,9 @@ def parse_image_rendering(quality):
     else:
         return skia.FilterQuality.kMedium_FilterQuality
 
-# 字体缓存
+# 字形缓存
 FONTS = {}
-def get_font(size, weight, style):
+def get_typeface(weight, style):
     key = (weight, style)
     if key not in FONTS:
         if weight == "bold":
@@ -137,15 +138,93 @@ def get_font(size, weight, style):
             skia.FontStyle(skia_weight, skia_width, skia_style)
         font = skia.Typeface('Arial', style_info)
         FONTS[key] = font
-    return skia.Font(FONTS[key], size)
+    return FONTS[key]
+
+# 字体对象缓存，每种缩放级别都会带来一批新字号，按最近使用淘汰；
+# 返回的字体是共享的，不能修改
+FONT_CACHE = OrderedDict()
+FONT_CACHE_LOCK = threading.Lock()
+def get_font(size, weight, style):
+    key = (weight, style, size)
+    with FONT_CACHE_LOCK:
+        font = FONT_CACHE.get(key)
+        if font is not None:
+            FONT_CACHE.move_to_end(key)
+            return font
+    font = skia.Font(get_typeface(weight, style), size)
+    font_metrics(font)
+    with FONT_CACHE_LOCK:
+        font = FONT_CACHE.setdefault(key, font)
+        while len(FONT_CACHE) > FONT_CACHE_ENTRIES:
+            FONT_CACHE.popitem(last=False)
+    return font
 
 def font(css_style, zoom, notify):
     weight = css_style['font-weight'].read(notify)
     style = css_style['font-style'].read(notify)
-    size = None
-    try:
-        size = float(css_style['font-size'].read(notify)[:-2]) * 0.75
-    except:
-        size = 16
+    size = css_style['font-size'].read(notify).px
+    size = size * 0.75 if size is not None else 16
     font_size = dpx(size, zoom)
-    return get_font(font_size, weight, style)
\ No newline at end of file
+    return get_font(font_size, weight, style)
+
+# 文字宽度和字体度量缓存：排版时量一次，换行、定位和绘制都复用，
+# 按(字形, 字号, 文本)做键，排版线程和浏览器线程都会用到，所以加锁
+class TextMeasureCache:
+    def __init__(self, max_entries=TEXT_MEASURE_CACHE_ENTRIES):
+        self.lock = threading.Lock()
+        self.widths = OrderedDict()
+        self.metrics = {}
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def measure(self, font, text):
+        key = (font.getTypeface().uniqueID(), font.getSize(), text)
+        with self.lock:
+            width = self.widths.get(key)
+            if width is not None:
+                self.widths.move_to_end(key)
+                self.hits += 1
+                return width
+            self.misses += 1
+        width = font.measureText(text)
+        with self.lock:
+            self.widths[key] = width
+            while len(self.widths) > self.max_entries:
+                self.widths.popitem(last=False)
+        return width
+
+    # 不同的字号不多，度量值超过上限时整个清空即可
+    def font_metrics(self, font):
+        key = (font.getTypeface().uniqueID(), font.getSize())
+        metrics = self.metrics.get(key)
+        if metrics is None:
+            metrics = font.getMetrics()
+            with self.lock:
+                if len(self.metrics) >= self.max_entries:
+                    self.metrics = {}
+                self.metrics[key] = metrics
+        return metrics
+
+    def clear(self):
+        with self.lock:
+            self.widths.clear()
+            self.metrics = {}
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.widths),
+            }
+
+TEXT_MEASURE_CACHE = TextMeasureCache()
+
+def measure_text(font, text):
+    return TEXT_MEASURE_CACHE.measure(font, text)
+
+def font_metrics(font):
+    return TEXT_MEASURE_CACHE.font_metrics(font)
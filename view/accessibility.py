@@ -3,6 +3,7 @@ import os
 import gtts
 import playsound
 from utils.util import *
+from utils.spatial_index import *
 from parser.css_parser import *
 
 def is_focusable(node):
@@ -34,6 +35,8 @@ class AccessibilityNode:
         self.parent = parent
         self.text = ""
         self.bounds = self.compute_bounds()
+        # 悬停命中测试用的空间索引，第一次悬停时建
+        self.hit_index = None
 
         if isinstance(node, Text):
             if is_focusable(node.parent):
@@ -147,14 +150,31 @@ class AccessibilityNode:
                 return True
         return False
 
+    # 同一个frame里的节点按前序放进空间索引，包含这个点的最后一个节点就是结果；
+    # iframe里的节点坐标不同，由iframe节点用自己的索引去查
     def hit_test(self, x, y):
-        node = None
-        if self.contains_point(x, y):
-            node = self
+        if self.hit_index is None:
+            entries = []
+            self.add_index_entries(entries)
+            self.hit_index = SpatialIndex(entries)
+        return self.index_hit_test(x, y)
+
+    def index_hit_test(self, x, y):
+        point = skia.Rect.MakeXYWH(x, y, 0, 0)
+        for bounds, node in reversed(self.hit_index.query(point)):
+            if isinstance(node, FrameAccessibilityNode) and node is not self:
+                res = node.hit_test(x, y)
+                if res: return res
+            elif bounds.contains(x, y):
+                return node
+        return None
+
+    def add_index_entries(self, entries):
+        for bounds in self.bounds:
+            entries.append((bounds, self))
+        if isinstance(self, FrameAccessibilityNode): return
         for child in self.children:
-            res = child.hit_test(x, y)
-            if res: node = res
-        return node
+            child.add_index_entries(entries)
 
     def __repr__(self):
         return "AccessibilityNode(node={} role={} text={} bounds={}".format(
@@ -164,7 +184,7 @@ class FrameAccessibilityNode(AccessibilityNode):
     def __init__(self, node, parent=None):
         super().__init__(node, parent)
         self.scroll = self.node.frame.scroll
-        self.zoom = self.node.layout_object.zoom
+        self.zoom = self.node.layout_object.zoom.get()
 
     def build(self):
         self.build_internal(self.node.frame.nodes)
@@ -174,11 +194,12 @@ class FrameAccessibilityNode(AccessibilityNode):
         if not bounds.contains(x, y): return
         new_x = x - bounds.left() - dpx(1, self.zoom)
         new_y = y - bounds.top() - dpx(1, self.zoom) + self.scroll
-        node = self
-        for child in self.children:
-            res = child.hit_test(new_x, new_y)
-            if res: node = res
-        return node
+        if self.hit_index is None:
+            entries = []
+            for child in self.children:
+                child.add_index_entries(entries)
+            self.hit_index = SpatialIndex(entries)
+        return self.index_hit_test(new_x, new_y) or self
 
     def map_to_parent(self, rect):
         bounds = self.bounds[0]
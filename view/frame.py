@@ -1,7 +1,10 @@
 import skia
 import math
+import codecs
+import threading
 import urllib.parse
 from parser.html_parser import *
+from parser.dom_index import *
 from layout import *
 from display.commit_data import *
 from utils.util import *
@@ -12,6 +15,8 @@ from common.protected_field import *
 from setting.config import *
 from utils.render_util import *
 from layout.document_layout import *
+from common.network import *
+from utils.spatial_index import *
 
 class Frame:
     def __init__(self, tab, parent_frame, frame_element):
@@ -23,16 +28,33 @@ class Frame:
         self.loaded = False
 
         self.js = None
+        self.parser = None
+        self.index = None
         self.nodes = None
         self.document = None
         self.needs_style = False
         self.needs_layout = False
+        self.restyled_nodes = 0
         
         self.scroll = 0
         self.scroll_changed_in_frame = True
         self.needs_focus_scroll = False
         self.frame_width = 0
         self.frame_height = 0
+        self.deferred_blocks = []
+        # 排过版的content-visibility: auto块，离开视口后重新跳过
+        self.skippable_blocks = set()
+        # 布局包含的块里有改动，等文档排版时单独排
+        self.layout_roots = []
+        # 缓存了绘制命令的块
+        self.paint_cached_blocks = set()
+        # 点击命中测试用的空间索引，布局或样式变了以后再用到时重建
+        self.hit_index = None
+        # 页面被导航替换后，还在路上的网络数据和加载任务都不再处理
+        self.discarded = False
+        self.body = None
+        # 每次导航加一，旧页面的子资源下载完成后不再处理
+        self.load_id = 0
 
         self.window_id = len(self.tab.window_id_to_frame)
         self.tab.window_id_to_frame[self.window_id] = self
@@ -46,9 +68,11 @@ class Frame:
         self.zoom = 1
         self.scroll = 0
         self.scroll_changed_in_frame = True
-        headers, body = url.request(self.url, payload)
-        body = body.decode("utf8", "replace")
+        if self.body: self.body.abort()
+        self.load_id += 1
+        headers, body = url.stream(self.url, payload)
         self.url = url
+        self.body = body
 
         self.allowed_origins = None
         if "content-security-policy" in headers:
@@ -56,55 +80,204 @@ class Frame:
            if len(csp) > 0 and csp[0] == "default-src":
                self.allowed_origins = csp[1:]
 
-        self.nodes = HTMLParser(body).parse()
-
         if self.js: self.js.discarded = True
         self.js = self.tab.get_js(url)
         self.js.add_window(self)
-        # 加载更多JS脚本
-        scripts = [node.attributes["src"] for node in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element) and node.tag == "script" and "src" in node.attributes]
-        for script in scripts:
-            script_url = url.resolve(script)
-            if not self.allowed_request(script_url):
-                print("Blocked script", script, "due to CSP")
-                continue
 
+        self.index = DOMIndex()
+        self.parser = HTMLParser(compact=COMPACT_DOM, index=self.index)
+        self.decoder = codecs.getincrementaldecoder("utf8")("replace")
+        self.rules = list(DEFAULT_STYLE_SHEET)
+        self.rule_set = None
+        self.style_cache = None
+        self.deferred_blocks = []
+        self.skippable_blocks = set()
+        self.layout_roots = []
+        self.paint_cached_blocks = set()
+        self.hit_index = None
+        self.script_fetches = []
+        self.style_fetches = []
+        self.image_fetches = []
+        # 解析出根节点后就可以开始渲染，剩下的数据交给后台线程边收边解析
+        parser = self.parser
+        data = None
+        while not parser.root:
+            try:
+                data = body.read()
+            except Exception:
+                body.close()
+                raise
+            self.receive(parser, data)
+            if not data: break
+
+        self.document = DocumentLayout(self.nodes, self)
+        self.set_needs_render()
+        self.loaded = True
+
+        if data:
+            threading.Thread(
+                target=self.receive_body,
+                args=(parser, body),
+                name="Network thread",
+                daemon=True,
+            ).start()
+
+    def receive_body(self, parser, body):
+        while parser == self.parser and not self.discarded:
+            try:
+                data = body.read()
+            except Exception as e:
+                body.close()
+                if self.discarded: return
+                task = Task(self.abort_load, parser, e)
+                self.tab.task_runner.schedule_task(task)
+                return
+            task = Task(self.receive, parser, data)
+            self.tab.task_runner.schedule_task(task)
+            if not data: return
+        body.close()
+
+    def receive(self, parser, data):
+        if parser != self.parser or self.discarded: return
+        if data:
+            parser.feed(self.decoder.decode(data))
+        else:
+            parser.feed(self.decoder.decode(b"", True))
+            parser.close()
+        self.nodes = parser.root
+
+        new_nodes = parser.pop_new_nodes()
+        for node in new_nodes:
+            if isinstance(node, Element):
+                self.discover(node)
+        self.load_styles()
+        self.load_images()
+
+        if self.document:
+            for node in new_nodes:
+                mark_layout_children(node.parent)
+            self.set_needs_render()
+        if not data:
+            self.finish_load()
+
+    # 文档没收完连接就断了：已经收到的部分照常显示，但不再运行脚本
+    def abort_load(self, parser, error):
+        if parser != self.parser or self.discarded: return
+        print("Load of", self.url, "interrupted:", error)
+        parser.feed(self.decoder.decode(b"", True))
+        parser.close()
+        self.nodes = parser.root
+        if self.document:
+            for node in parser.pop_new_nodes():
+                mark_layout_children(node.parent)
+            self.set_needs_render()
+        self.script_fetches = []
+        self.finish_load()
+
+    # 脚本按文档顺序运行：文档解析完、样式表都到了以后，前面的脚本到了才运行后面的
+    def run_scripts(self):
+        if self.parser or self.style_fetches: return
+        while self.script_fetches:
+            script_url, future = self.script_fetches[0]
+            if not future.done(): return
+            self.script_fetches.pop(0)
             try:
-                header, body = script_url.request(url)
+                header, body = future.result()
             except:
                 continue
             body = body.decode("utf8", "replace")
             task = Task(self.js.run, script_url, body, self.window_id)
             self.tab.task_runner.schedule_task(task)
-        # 加载CSS
-        self.rules = DEFAULT_STYLE_SHEET.copy()
-        links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and node.attributes.get("rel") == "stylesheet"
-                 and "href" in node.attributes]
-        for link in links:  
-            style_url = url.resolve(link)
+
+    # 导航到新页面时丢弃旧页面：停止接收文档，排队中的加载任务直接返回
+    def discard(self):
+        self.discarded = True
+        self.loaded = False
+        self.parser = None
+        if self.body: self.body.abort()
+
+    # 解析过程中发现子资源就立刻发出请求
+    def discover(self, node):
+        if node.tag == "script" and "src" in node.attributes:
+            script_url = self.url.resolve(node.attributes["src"])
+            if not self.allowed_request(script_url):
+                print("Blocked script", node.attributes["src"], "due to CSP")
+                return
+            self.script_fetches.append(
+                (script_url, self.watch(fetch(script_url, self.url))))
+        elif node.tag == "link" \
+            and node.attributes.get("rel") == "stylesheet" \
+            and "href" in node.attributes:
+            style_url = self.url.resolve(node.attributes["href"])
             if not self.allowed_request(style_url):
-                print("Blocked style", link, "due to CSP")
-                continue
+                print("Blocked style", node.attributes["href"], "due to CSP")
+                return
+            self.style_fetches.append(
+                (style_url, self.watch(fetch(style_url, self.url))))
+        elif node.tag == "img":
             try:
-                header, body = style_url.request(url)
+                src = node.attributes.get("src", "")
+                image_url = self.url.resolve(src)
+                assert self.allowed_request(image_url), \
+                    "Blocked load of " + str(image_url) + " due to CSP"
+                self.image_fetches.append(
+                    (node, image_url, self.watch(fetch(image_url, self.url))))
+            except Exception as e:
+                print("Image", node.attributes.get("src", ""), "crashed", e)
+                node.image = BROKEN_IMAGE
+        elif node.tag == "iframe" and "src" in node.attributes:
+            document_url = self.url.resolve(node.attributes["src"])
+            if not self.allowed_request(document_url):
+                print("Blocked iframe", document_url, "due to CSP")
+                node.frame = None
+                return
+            node.frame = Frame(self.tab, self, node)
+            task = Task(node.frame.load, document_url)
+            self.tab.task_runner.schedule_task(task)
+
+    # 子资源下载完成时回到任务线程处理，任务线程从不等待网络
+    def watch(self, future):
+        load_id = self.load_id
+        def done(future):
+            task = Task(self.resource_loaded, load_id)
+            self.tab.task_runner.schedule_task(task)
+        future.add_done_callback(done)
+        return future
+
+    def resource_loaded(self, load_id):
+        if load_id != self.load_id or self.discarded: return
+        self.load_styles()
+        self.load_images()
+        self.run_scripts()
+
+    # 样式表按文档顺序生效，前面的还没下载完时后面的要等待
+    def load_styles(self):
+        changed = False
+        while self.style_fetches:
+            style_url, future = self.style_fetches[0]
+            if not future.done(): break
+            self.style_fetches.pop(0)
+            try:
+                header, body = future.result()
             except:
                 continue
-            self.rules.extend(CSSParser(body.decode("utf8", "replace")).parse())
-        # 加载图片
-        images = [node for node in tree_to_list(self.nodes, [])
-                  if isinstance(node, Element) and node.tag == "img"]
-        for img in images:
+            self.rules.extend(
+                STYLE_SHEET_CACHE.get(str(style_url), header, body))
+            self.rule_set = None
+            changed = True
+        if changed and self.nodes:
+            for node in tree_to_list(self.nodes, []):
+                dirty_style(node)
+            self.set_needs_render()
+
+    def load_images(self):
+        pending = []
+        for img, image_url, future in self.image_fetches:
+            if not future.done():
+                pending.append((img, image_url, future))
+                continue
             try:
-                src = img.attributes.get("src", "")
-                image_url = url.resolve(src)
-                assert self.allowed_request(image_url), \
-                    "Blocked load of " + str(image_url) + " due to CSP"
-                header, body = image_url.request(url)
+                header, body = future.result()
                 img.encoded_data = body
                 data = skia.Data.MakeWithoutCopy(body)
                 img.image = skia.Image.MakeFromEncoded(data)
@@ -113,22 +286,21 @@ class Frame:
             except Exception as e:
                 print("Image", img.attributes.get("src", ""), "crashed", e)
                 img.image = BROKEN_IMAGE
-        # 加载iframe
-        iframes = [node for node in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element) and node.tag == "iframe" and "src" in node.attributes]
-        for iframe in iframes:
-            document_url = url.resolve(iframe.attributes["src"])
-            if not self.allowed_request(document_url):
-                print("Blocked iframe", document_url, "due to CSP")
-                iframe.frame = None
-                continue
-            iframe.frame = Frame(self.tab, self, iframe)
-            task = Task(iframe.frame.load, document_url)
-            self.tab.task_runner.schedule_task(task)
+            if self.document:
+                mark_layout_children(img)
+                self.set_needs_render()
+        self.image_fetches = pending
 
-        self.document = DocumentLayout(self.nodes, self)
-        self.set_needs_render()
-        self.loaded = True
+    def finish_load(self):
+        self.parser = None
+        self.run_scripts()
+
+        self.tab.browser.measure.counter(
+            "connection-pool", CONNECTION_POOL.stats())
+        self.tab.browser.measure.counter(
+            "http-cache", HTTP_CACHE.stats())
+        self.tab.browser.measure.counter(
+            "stylesheet-cache", STYLE_SHEET_CACHE.stats())
     ##########################
     # 渲染
     ##########################
@@ -144,25 +316,115 @@ class Frame:
 
     def render(self):
         if self.needs_style:
-            style(self.nodes, sorted(self.rules, key=cascade_priority), self)
+            # 样式表变化后才重新排序、分桶
+            if not self.rule_set:
+                self.rule_set = RuleSet(self.rules)
+                self.style_cache = StyleSharingCache()
+            self.restyled_nodes = 0
+            style(self.nodes, self.rule_set, self)
+            self.tab.browser.measure.counter(
+                "style", {"restyled_nodes": self.restyled_nodes})
+            if self.restyled_nodes:
+                self.hit_index = None
             self.needs_layout = True
             self.needs_style = False
 
-        if self.needs_layout:
-            self.document.layout(self.frame_width, self.tab.zoom)
-            self.tab.needs_accessibility = True
-            self.needs_layout = False
+        self.skip_offscreen_blocks()
+        realized = self.realize_deferred_blocks()
+        while True:
+            if realized:
+                self.needs_layout = True
+
+            if self.needs_layout:
+                if self.layout_roots or self.document.layout_needed():
+                    self.hit_index = None
+                self.document.layout(self.frame_width, self.tab.zoom)
+                self.tab.needs_accessibility = True
+                self.needs_layout = False
+
+            # 视口上方的块排版后高度和估算不同，调整滚动位置让看到的内容不动
+            for block, y, height in realized:
+                if y + height <= self.scroll:
+                    self.scroll += block.height.get() - height
+                    self.scroll_changed_in_frame = True
+
+            clamped_scroll = self.clamp_scroll(self.scroll)
+            if clamped_scroll != self.scroll:
+                self.scroll_changed_in_frame = True
+            self.scroll = clamped_scroll
+
+            # 排版改了块的位置、滚动位置也可能被修正，还推迟着的块可能已经进入视口，
+            # 不排好就会画成空白
+            realized = self.realize_deferred_blocks()
+            if not realized: break
+    # 离视口足够远的块先不排版，在排版过程中由BlockLayout询问；
+    # content-visibility: auto的块在视口上方也可以跳过
+    def defer_layout(self, block):
+        if not LAZY_LAYOUT and not block.skippable: return False
+        if self.near_viewport(block, block.y.get()):
+            if block.skippable:
+                self.skippable_blocks.add(block)
+            return False
+        self.deferred_blocks.append(block)
+        return True
+
+    def near_viewport(self, block, y):
+        bottom = self.scroll + self.frame_height + LAZY_LAYOUT_MARGIN
+        if not block.skippable: return y <= bottom
+        top = self.scroll - LAZY_LAYOUT_MARGIN
+        return y <= bottom and y + (block.height.value or 0) >= top
+
+    # 滚动到附近的推迟块开始真正排版，返回它们排版前的位置和估算高度
+    def realize_deferred_blocks(self):
+        if not self.deferred_blocks: return []
+        realized = []
+        remaining = []
+        for block in self.deferred_blocks:
+            if not block.deferred or block.detached: continue
+            if not self.near_viewport(block, block.y.value):
+                remaining.append(block)
+                continue
+            realized.append((block, block.y.value, block.height.value))
+            block.realize()
+        self.deferred_blocks = remaining
+        return realized
+
+    # 节点的绘制结果变了，清掉祖先块上缓存的绘制命令
+    def invalidate_paint(self, node):
+        if not self.paint_cached_blocks: return
+        while node:
+            obj = node.layout_object
+            if isinstance(obj, BlockLayout) and obj.paint_cache is not None:
+                obj.paint_cache = None
+                self.paint_cached_blocks.discard(obj)
+            node = node.parent
+
+    def skip_offscreen_blocks(self):
+        visible = set()
+        for block in self.skippable_blocks:
+            if block.deferred or block.detached: continue
+            if self.near_viewport(block, block.y.value) or \
+                self.contains_focus(block):
+                visible.add(block)
+                continue
+            block.defer()
+            self.deferred_blocks.append(block)
+            self.needs_layout = True
+        self.skippable_blocks = visible
+
+    def contains_focus(self, block):
+        node = self.tab.focus
+        while node:
+            if node is block.node: return True
+            node = node.parent
+        return False
 
-        clamped_scroll = self.clamp_scroll(self.scroll)
-        if clamped_scroll != self.scroll:
-            self.scroll_changed_in_frame = True
-        self.scroll = clamped_scroll
     ##############################
     # 用户事件
     ##############################
     def advance_tab(self):
-        focusable_nodes = [node for node in tree_to_list(self.nodes, [])
-                           if isinstance(node, Element) and is_focusable(node) and get_tabindex(node) >= 0]
+        focusable_nodes = [node for node in self.index.focusable_nodes()
+                           if is_focusable(node) and get_tabindex(node) >= 0]
         focusable_nodes.sort(key=get_tabindex)
 
         if self.tab.focus in focusable_nodes:
@@ -183,14 +445,40 @@ class Frame:
             self.needs_focus_scroll = True
         if self.tab.focus:
             self.tab.focus.is_focused = False
-            dirty_style(self.tab.focus)
+            self.tab.focused_frame.invalidate_paint(self.tab.focus)
+            self.tab.focused_frame.invalidate_focus(self.tab.focus)
         if self.tab.focused_frame and self.tab.focused_frame != self:
             self.tab.focused_frame.set_needs_render()
         self.tab.focus = node
         self.tab.focused_frame = self
         if node:
             node.is_focused = True
+            self.invalidate_paint(node)
+            self.invalidate_focus(node)
+        self.set_needs_render()
+
+    # 只让依赖:focus的规则可能影响的属性失效
+    def invalidate_focus(self, node):
+        if not self.rule_set:
             dirty_style(node)
+            return
+        dirty_style(node, self.rule_set.focus_properties(node))
+        properties = self.rule_set.focus_descendant_properties
+        if properties:
+            for descendant in tree_to_list(node, [])[1:]:
+                dirty_style(descendant, properties)
+
+    # 切换配色时只有带媒体查询的规则匹配到的元素和根元素的默认颜色会变
+    def invalidate_color_scheme(self):
+        if not self.nodes: return
+        if not self.rule_set:
+            for node in tree_to_list(self.nodes, []):
+                dirty_style(node)
+        else:
+            for media, selector, body in self.rule_set.media_rules:
+                for node in self.index.query(selector):
+                    dirty_style(node, body.keys())
+            dirty_style(self.nodes, ["color"])
         self.set_needs_render()
 
     def activate_element(self, elt):
@@ -231,6 +519,7 @@ class Frame:
                 self.activate_element(self.tab.focus)
             if self.js.dispatch_event("keydown", self.tab.focus, self.window_id): return
             self.tab.focus.attributes["value"] += char
+            self.invalidate_paint(self.tab.focus)
             self.set_needs_render()
         elif self.tab.focus and "contenteditable" in self.tab.focus.attributes:
             text_nodes = [t for t in tree_to_list(self.tab.focus, [])
@@ -239,12 +528,10 @@ class Frame:
                 last_text = text_nodes[-1]
             else:
                 last_text = Text("", self.tab.focus)
-                self.tab.focus.children.append(last_text)
+                append_child(self.tab.focus, last_text)
+            old_text = last_text.text
             last_text.text += char
-            obj = self.tab.focus.layout_object
-            while not isinstance(obj, BlockLayout):
-                obj = obj.parent
-            obj.children.mark()
+            mark_text_changed(last_text, old_text)
             self.set_needs_render()
 
     def scrolldown(self):
@@ -257,8 +544,12 @@ class Frame:
             obj for obj in tree_to_list(self.document, [])
             if obj.node == self.tab.focus
         ]
-        if not objs: return
-        obj = objs[0]
+        if objs:
+            obj = objs[0]
+        else:
+            # 还没排版的元素先滚到推迟块估算的位置，下一帧就会真正排版
+            obj = enclosing_block(self.tab.focus)
+            if not obj or not obj.deferred: return
 
         if self.scroll < obj.y.get() < self.scroll + self.frame_height:
             return
@@ -270,8 +561,8 @@ class Frame:
         self.focus_element(None)
         y += self.scroll
         loc_rect = skia.Rect.MakeXYWH(x, y, 1, 1)
-        objs = [obj for obj in tree_to_list(self.document, [])
-                if absolute_bounds_for_obj(obj).intersects(loc_rect)]
+        objs = [obj for bounds, obj in self.hit_test_index().query(loc_rect)
+                if bounds.intersects(loc_rect)]
         if not objs: return
         elt = objs[-1].node
         if elt and self.js.dispatch_event(
@@ -294,6 +585,13 @@ class Frame:
                 return
             elt = elt.parent
 
+    def hit_test_index(self):
+        if self.hit_index is None:
+            objs = tree_to_list(self.document, [])
+            self.hit_index = SpatialIndex(
+                list(zip(absolute_bounds_for_objs(objs), objs)))
+        return self.hit_index
+
     def clamp_scroll(self, scroll):
         height = math.ceil(self.document.height.get() + 2*VSTEP)
         maxscroll = height - self.frame_height
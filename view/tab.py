@@ -43,6 +43,8 @@ class Tab:
     def load(self, url, payload=None):
         self.history.append(url)
         self.task_runner.clear_pending_tasks()
+        for frame in self.window_id_to_frame.values():
+            frame.discard()
         self.root_frame = Frame(self, None, None)
         self.root_frame.load(url, payload)
         self.root_frame.frame_width = WIDTH
@@ -110,10 +112,13 @@ class Tab:
             self.browser.measure.stop('script-runRAFHandlers')
 
             for node in tree_to_list(frame.nodes, []):
+                if not node.animations: continue
                 for (property_name, animation) in node.animations.items():
                     value = animation.animate()
                     if value:
-                        node.style[property_name].set(value)
+                        node.style[property_name].set(
+                            typed_value(property_name, value))
+                        frame.invalidate_paint(node)
                         if property_name == "opacity":
                             self.composited_updates.append(node)
                             self.set_needs_paint()
@@ -204,7 +209,9 @@ class Tab:
             INHERITED_PROPERTIES["color"] = "white"
         else:
             INHERITED_PROPERTIES["color"] = "black"
-        dirty_style(self.root_frame.nodes)
+        for frame in self.window_id_to_frame.values():
+            if frame.loaded:
+                frame.invalidate_color_scheme()
         self.set_needs_render_all_frames()
 
     def advance_tab(self):
@@ -223,6 +230,13 @@ class Tab:
         self.set_needs_paint()
 
 def paint_tree(layout_object, display_list):
+    if isinstance(layout_object, BlockLayout):
+        # 跳过排版的块整棵子树都不产生绘制命令
+        if layout_object.deferred:
+            return
+        if layout_object.paint_cache is not None:
+            display_list.extend(layout_object.paint_cache)
+            return
     cmds = layout_object.paint()
 
     if isinstance(layout_object, IframeLayout) and \
@@ -238,4 +252,6 @@ def paint_tree(layout_object, display_list):
                 paint_tree(child, cmds)
 
     cmds = layout_object.paint_effects(cmds)
+    if isinstance(layout_object, BlockLayout):
+        layout_object.cache_paint(cmds)
     display_list.extend(cmds)
\ No newline at end of file